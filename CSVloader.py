@@ -0,0 +1,260 @@
+# loader for CSVplotter: reads a CSV file chunk by chunk into a float array on disk
+# (memory-mapped) and builds a min/max pyramid of it, so the viewer can show an
+# overview right away and read the details only for the visible range.
+# memory use is bounded by the chunk size and the plot width, not by the file size.
+#
+# files of a loaded CSV (in <directory>):
+#   data.f64            rows x columns, float64, non numeric values are NaN
+#   min<k>.f64 max<k>.f64  level k of the pyramid: min/max of blocks of BLOCK*FACTOR**(k-1) rows
+#   meta.json           labels, rows and levels, written last: a directory without it is incomplete
+#
+# with a CSVCache, these files are kept in the cache directory, keyed by path, size,
+# modification time and delimiter of the CSV, so opening the same file again only maps them.
+# every load writes into a directory of its own, publish() moves it to the key when it is
+# complete: two loads of the same file (or a cancelled one) never touch each other's files.
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+CHUNKSIZE = 131072  # rows parsed at once, a multiple of the block sizes of the first LEVELS levels
+BLOCK = 16          # rows per block of the first pyramid level
+FACTOR = 8          # blocks of a level per block of the next level
+LEVELS = 4          # levels built while parsing, finish() adds more for very large files
+OVERVIEW = 4096     # the top level has at most this number of blocks
+CACHEDIR = os.path.join(os.path.expanduser('~'), '.cache', 'CSVplotter')
+CACHESIZE = 4 * 1024**3 # bytes, least recently used entries are removed above this
+STALE = 24 * 3600   # seconds, older load directories are left over from a crash and removed by evict()
+
+
+class CSVCache:
+    def __init__(self, directory=CACHEDIR, maxsize=CACHESIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+
+    def entry(self, filename, delimiter):
+        # directory for a CSV file, a changed file (size, mtime) gets a new one. only complete loads are in it
+        stat = os.stat(filename)
+        key = F'{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}|{delimiter}'
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest())
+
+    def loading(self, entry):
+        # a new directory for one load of <entry>, "<entry>.<random>"
+        os.makedirs(self.directory, exist_ok=True)
+        return tempfile.mkdtemp(prefix=os.path.basename(entry) + '.', dir=self.directory)
+
+    def evict(self, keep=()):
+        # removes the least recently used entries until the cache fits into maxsize
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir():
+                continue
+            if '.' in entry.name and time.time() - entry.stat().st_mtime < STALE: # another load, still running
+                continue
+            size = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            meta = os.path.join(entry.path, 'meta.json')
+            used = os.path.getmtime(meta) if os.path.exists(meta) else 0 # incomplete entries go first
+            entries.append((used, size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for used, size, path in sorted(entries):
+            if total <= self.maxsize:
+                break
+            if path in keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+class CSVData:
+    def __init__(self, filename, delimiter, use_first_column_as_x=False, cache=None):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.use_first_column_as_x = use_first_column_as_x
+        self.cache = cache
+        self.entry = None if cache is None else cache.entry(filename, delimiter)
+        self.directory = tempfile.mkdtemp(prefix='csvplotter_') if cache is None else self.entry
+        self.loading = cache is None # self.directory is ours: created for this load, removed by discard()
+        self.labels = []    # all columns, including the x column
+        self.rows = 0
+        self.data = None    # memmap rows x columns
+        self.levels = []    # (blocksize, min memmap, max memmap) per pyramid level, finest first
+        self.nlevels = LEVELS
+
+    def chunks(self):
+        # parses the CSV chunk by chunk and appends it to data.f64, the first LEVELS levels of the
+        # pyramid are built on the way. yields the number of rows so far and the fraction of the
+        # file read, all files are flushed at that point (see open()).
+        if not self.loading:
+            self.directory = self.cache.loading(self.entry)
+            self.loading = True
+        size = max(1, os.path.getsize(self.filename))
+        with open(self.filename, 'rb') as source, contextlib.ExitStack() as files:
+            f = files.enter_context(open(os.path.join(self.directory, 'data.f64'), 'wb'))
+            levelfiles = [(files.enter_context(open(os.path.join(self.directory, F'min{level}.f64'), 'wb')),
+                           files.enter_context(open(os.path.join(self.directory, F'max{level}.f64'), 'wb')))
+                          for level in range(1, LEVELS + 1)]
+            for chunk in pd.read_csv(source, delimiter=self.delimiter, chunksize=CHUNKSIZE):
+                if not self.labels:
+                    self.labels = [str(column) for column in chunk.columns]
+                values = chunk.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float64)
+                f.write(values.tobytes())
+                f.flush()
+                level_min = level_max = values
+                factor = BLOCK
+                for file_min, file_max in levelfiles:
+                    level_min, level_max = self.reduce(level_min, level_max, factor)
+                    file_min.write(level_min.tobytes())
+                    file_max.write(level_max.tobytes())
+                    file_min.flush()
+                    file_max.flush()
+                    factor = FACTOR
+                self.rows += len(values)
+                yield self.rows, source.tell() / size
+
+    def reduce(self, level_min, level_max, factor):
+        # min/max of every <factor> rows
+        starts = np.arange(0, len(level_min), factor)
+        with np.errstate(invalid='ignore'):
+            return np.fmin.reduceat(level_min, starts, axis=0), np.fmax.reduceat(level_max, starts, axis=0)
+
+    def load(self):
+        if not self.cached():
+            for _ in self.chunks():
+                pass
+            self.finish()
+            self.publish()
+        self.open()
+
+    def cached(self):
+        # True if the files of an earlier load of the same CSV are there, open() maps them
+        meta = os.path.join(self.directory, 'meta.json')
+        if self.cache is None or not os.path.exists(meta):
+            return False
+        with open(meta) as f:
+            meta = json.load(f)
+        self.labels = meta['labels']
+        self.rows = meta['rows']
+        self.nlevels = meta['levels']
+        os.utime(os.path.join(self.directory, 'meta.json')) # last use, for the eviction
+        return True
+
+    def finish(self):
+        # after the last chunk: build the remaining levels and mark the cache entry complete.
+        # only works on the files, so it can run in a loader thread while the GUI shows the data so far
+        level = self.nlevels
+        blocks = -(-self.rows // self.blocksize(level))
+        while blocks > OVERVIEW:
+            source_min = self.map(F'min{level}.f64', blocks, 'r')
+            source_max = self.map(F'max{level}.f64', blocks, 'r')
+            blocks = -(-blocks // FACTOR)
+            level += 1
+            level_min = self.map(F'min{level}.f64', blocks, 'w+')
+            level_max = self.map(F'max{level}.f64', blocks, 'w+')
+            step = CHUNKSIZE // FACTOR * FACTOR
+            for start in range(0, len(source_min), step):
+                stop = min(start + step, len(source_min))
+                level_min[start // FACTOR:-(-stop // FACTOR)], level_max[start // FACTOR:-(-stop // FACTOR)] = \
+                    self.reduce(source_min[start:stop], source_max[start:stop], FACTOR)
+            level_min.flush()
+            level_max.flush()
+            del level_min, level_max
+        self.nlevels = level
+        if self.cache is not None:
+            with open(os.path.join(self.directory, 'meta.json'), 'w') as f:
+                json.dump({'filename': self.filename, 'labels': self.labels, 'rows': self.rows,
+                           'levels': self.nlevels}, f)
+
+    def publish(self):
+        # after finish(), in the thread that maps the files: the complete load becomes the cache entry.
+        # if another load of the same file was first, its entry is used and this one removed
+        if self.cache is None or not self.loading:
+            return
+        self.close() # unmapped: Windows can't move mapped files
+        if not os.path.exists(os.path.join(self.entry, 'meta.json')): # an incomplete entry of an older version
+            shutil.rmtree(self.entry, ignore_errors=True)
+        try:
+            os.replace(self.directory, self.entry)
+        except OSError: # the entry exists already
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = self.entry
+        self.loading = False
+        self.cached()
+        self.cache.evict(keep=(self.directory,))
+
+    def blocksize(self, level):
+        return BLOCK * FACTOR**(level - 1)
+
+    def open(self, rows=None):
+        # maps the data and the pyramid, the first <rows> rows only while the loader is still running
+        rows = self.rows if rows is None else rows
+        self.levels = []
+        if rows:
+            self.data = self.map('data.f64', rows, 'r')
+            for level in range(1, self.nlevels + 1):
+                blocks = -(-rows // self.blocksize(level))
+                self.levels.append((self.blocksize(level), self.map(F'min{level}.f64', blocks, 'r'),
+                                    self.map(F'max{level}.f64', blocks, 'r')))
+        else:
+            self.data = np.empty((0, len(self.labels)))
+
+    def map(self, name, rows, mode):
+        return np.memmap(os.path.join(self.directory, name), dtype=np.float64, mode=mode,
+                         shape=(rows, len(self.labels)))
+
+    def columns(self):
+        # indices of the columns to plot
+        return list(range(1 if self.use_first_column_as_x else 0, len(self.labels)))
+
+    def xrange(self):
+        # first and last x value of the mapped data
+        if self.use_first_column_as_x and len(self.data):
+            return self.data[0, 0], self.data[-1, 0]
+        return 0, len(self.data)
+
+    def index(self, x):
+        # x value -> row, the x column is expected to be sorted (time)
+        if self.use_first_column_as_x:
+            return int(np.searchsorted(self.data[:, 0], x))
+        return int(x)
+
+    def view(self, column, x0=None, x1=None, points=2000):
+        # (x, y) of a column between x0 and x1 with about <points> points:
+        # raw rows if there are not more, else min/max pairs of the best fitting pyramid level
+        rows = len(self.data)
+        first = 0 if x0 is None else min(max(0, self.index(x0) - 1), rows)
+        last = rows if x1 is None else min(max(0, self.index(x1) + 1), rows)
+        for blocksize, level_min, level_max in reversed([(1, None, None)] + self.levels):
+            if blocksize == 1 or (last - first) // blocksize >= points // 2:
+                break
+        if blocksize == 1:
+            y = np.array(self.data[first:last, column])
+            x = np.array(self.data[first:last, 0]) if self.use_first_column_as_x else np.arange(first, last)
+            return x, y
+        # the coarsest level that still has at least <points>/2 blocks in view
+        a = first // blocksize
+        b = -(-last // blocksize)
+        y = np.empty(2 * (b - a))
+        y[0::2] = level_min[a:b, column]
+        y[1::2] = level_max[a:b, column]
+        if self.use_first_column_as_x:
+            x = np.repeat(level_min[a:b, 0], 2)
+        else:
+            x = np.repeat(np.arange(a, b) * blocksize, 2)
+        return x, y
+
+    def close(self):
+        self.data = None
+        self.levels = []
+        if self.cache is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def discard(self):
+        # for a cancelled load: removes its incomplete files, never a cache entry (another load may use it)
+        self.close()
+        if self.loading:
+            shutil.rmtree(self.directory, ignore_errors=True)
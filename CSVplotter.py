@@ -1,12 +1,36 @@
 # viewer for the csv files written by SerialDataPlotter
 # almost entirely generated by Github Copilot, only minor adjustments
 import sys
-import pandas as pd
 from PyQt5.QtWidgets import QMainWindow, QFileDialog, QAction, QInputDialog, QWidget, QVBoxLayout, QDialog, QVBoxLayout, QHBoxLayout, QLabel, QLineEdit, QCheckBox, QPushButton, QColorDialog, QDialogButtonBox, QColorDialog
 from PyQt5.QtGui import QColor
 import PyQt5.QtWidgets as QtWidgets
 import pyqtgraph as pg
 import pyqtgraph
+from CSVloader import CSVData, CSVCache
+
+ROWHEIGHT = 150  # minimum height of a plot, more rows than fit into the window scroll
+
+class CSVLoaderThread(pg.QtCore.QThread):
+    # parses a CSV in the background, reports after every chunk so the plots can grow
+    progress = pg.QtCore.pyqtSignal(int, float)  # rows so far, fraction of the file
+    loaded = pg.QtCore.pyqtSignal()
+    failed = pg.QtCore.pyqtSignal(str)
+
+    def __init__(self, csvdata, parent=None):
+        super().__init__(parent)
+        self.csvdata = csvdata
+        self.cancelled = False
+
+    def run(self):
+        try:
+            for rows, fraction in self.csvdata.chunks():
+                if self.cancelled:
+                    return
+                self.progress.emit(rows, fraction)
+            self.csvdata.finish()
+            self.loaded.emit()
+        except Exception as e:
+            self.failed.emit(str(e))
 
 class OptionsDialog(QDialog):
     def __init__(self, parent=None):
@@ -83,6 +107,13 @@ class CSVPlotter(QMainWindow):
         self.foreground_color = '#000000'  # Default foreground color
         self.background_color = '#FFFFFF'  # Default background color
         self.grid_visible = True  # Default grid visibility
+        self.fileName = None
+        self.csvdata = []  # loaded files, see CSVloader.py
+        self.rows = []     # rows of the plot layout: {'plot', 'curve', 'csvdata', 'column', 'data'}
+        self.pool = []     # (plot item, curve) not in the layout right now, reused before creating new ones
+        self.zoomed = set() # CSVData zoomed/panned by the user, the others always show everything
+        self.loaders = []  # running CSVLoaderThreads
+        self.cache = CSVCache()  # parsed files, reopening them or changing options does not parse again
 
         # Pen colors for white background
         self.pen_colors = ['#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b', '#e377c2', '#7f7f7f', '#bcbd22', '#17becf']
@@ -115,6 +146,28 @@ class CSVPlotter(QMainWindow):
         self.setCentralWidget(self.central_widget)
         self.layout = QVBoxLayout(self.central_widget)
 
+        # one layout for all plots, plot items are reused when files or options change.
+        # with many columns it gets higher than the window and scrolls, curves of rows
+        # out of sight hold no data (see update_detail)
+        self.graph = pg.GraphicsLayoutWidget()
+        self.scroll_area = QtWidgets.QScrollArea(widgetResizable=True)
+        self.scroll_area.setWidget(self.graph)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(lambda _: self.detail_timer.start())
+        self.layout.addWidget(self.scroll_area)
+        # load the details when zooming/panning/scrolling, at most every 50 ms
+        self.detail_timer = pg.QtCore.QTimer(self, singleShot=True, interval=50)
+        self.detail_timer.timeout.connect(self.update_details)
+
+        # progress of files loading in the background
+        self.progress_bar = QtWidgets.QProgressBar(maximum=1000, textVisible=False)
+        self.progress_bar.setMaximumWidth(200)
+        self.cancel_button = QPushButton('Cancel')
+        self.cancel_button.clicked.connect(self.cancel_loading)
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.statusBar().addPermanentWidget(self.cancel_button)
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+
     def show_options_dialog(self):
         options_dialog = OptionsDialog(self)
         options_dialog.delimiter_edit.setText(self.delimiter)
@@ -126,25 +179,29 @@ class CSVPlotter(QMainWindow):
         options_dialog.color_order_edit.setText(','.join(self.pen_colors))
 
         if options_dialog.exec_() == QDialog.Accepted:
+            delimiter = self.delimiter
+            use_first_column_as_x = self.use_first_column_as_x
             self.delimiter = options_dialog.delimiter_edit.text()
             self.grid_visible = options_dialog.show_grid_checkbox.isChecked()
             self.foreground_color = options_dialog.foreground_color.name()
             self.background_color = options_dialog.background_color.name()
             self.pen_colors = options_dialog.color_order_edit.text().split(',')
             self.use_first_column_as_x = options_dialog.use_first_column_as_x_checkbox.isChecked()
-            if self.fileName:
-                # Clear existing plots
-                for i in reversed(range(self.layout.count())):
-                    widget = self.layout.itemAt(i).widget()
-                    if widget is not None:
-                        widget.deleteLater()
-                self.plot_csv()
+            if self.delimiter != delimiter: # parse all files again (or take them from the cache)
+                filenames = [csvdata.filename for csvdata in self.csvdata]
+                self.close_csvdata()
+                for self.fileName in filenames:
+                    self.plot_csv()
+            elif self.use_first_column_as_x != use_first_column_as_x: # same data, other columns
+                for csvdata in self.csvdata:
+                    csvdata.use_first_column_as_x = self.use_first_column_as_x
+                self.zoomed = set()
+                self.layout_rows()
+            else: # only colors and grid
+                self.apply_style()
 
     def open_file(self, event=None):
-        for i in reversed(range(self.layout.count())):
-            widget = self.layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
+        self.close_csvdata()
         options = QFileDialog.Options()
         self.fileName, _ = QFileDialog.getOpenFileName(self, "Open CSV File", "", "CSV Files (*.csv);;All Files (*)", options=options)
         if self.fileName:
@@ -157,60 +214,171 @@ class CSVPlotter(QMainWindow):
             self.plot_csv() 
 
     def plot_csv(self):
-        data = pd.read_csv(self.fileName, delimiter=self.delimiter)
+        # the file is parsed in chunks into a memory-mapped array, the plots show a min/max overview
+        # and load the details for the visible range only (see CSVloader.py).
+        # parsing runs in a CSVLoaderThread, the plots grow with every chunk
+        csvdata = CSVData(self.fileName, self.delimiter, self.use_first_column_as_x, self.cache)
+        self.csvdata.append(csvdata)
+        if csvdata.cached(): # parsed before: just map it
+            csvdata.open()
+            self.layout_rows()
+            return
+        loader = CSVLoaderThread(csvdata, self)
+        loader.progress.connect(lambda rows, fraction: self.show_progress(loader, rows, fraction))
+        loader.loaded.connect(lambda: self.show_loaded(loader))
+        loader.failed.connect(lambda error: self.statusBar().showMessage(F'Error loading {csvdata.filename}: {error}'))
+        loader.finished.connect(lambda: self.loader_finished(loader))
+        self.loaders.append(loader)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+        self.statusBar().showMessage(F'Loading {csvdata.filename}')
+        loader.start()
+
+    def show_progress(self, loader, rows, fraction):
+        if loader.cancelled:
+            return
+        self.progress_bar.setValue(int(fraction * 1000))
+        loader.csvdata.open(rows)
+        self.show_data(loader.csvdata)
+
+    def show_loaded(self, loader):
+        csvdata = loader.csvdata
+        csvdata.publish()
+        csvdata.open()
+        self.show_data(csvdata)
+        self.statusBar().showMessage(F'Loaded {csvdata.filename}: {csvdata.rows} rows', 5000)
+
+    def show_data(self, csvdata):
+        if csvdata not in [row['csvdata'] for row in self.rows]:
+            self.layout_rows()
+        else:
+            self.update_detail(csvdata)
 
-        # Create a list to hold all plot widgets
-        plotWidgets = []
+    def loader_finished(self, loader):
+        self.loaders.remove(loader)
+        if loader.cancelled:
+            loader.csvdata.discard()
+            if loader.csvdata in self.csvdata:
+                self.csvdata.remove(loader.csvdata)
+                self.layout_rows()
+            self.statusBar().showMessage(F'Cancelled loading {loader.csvdata.filename}', 5000)
+        if not self.loaders:
+            self.progress_bar.hide()
+            self.cancel_button.hide()
+
+    def cancel_loading(self):
+        for loader in self.loaders:
+            loader.cancelled = True
+
+    def create_plot(self):
+        # a new plot item for the pool, connected once for its whole life
+        font = pg.QtGui.QFont()
+        font.setPixelSize(11)
+        plot = pg.PlotItem()
+        plot.getAxis('left').setStyle(tickFont = font)
+        plot.getAxis('bottom').setStyle(tickFont = font)
+        curve = plot.plot()
+        plot.getViewBox().sigRangeChangedManually.connect(lambda _: self.range_changed_manually(plot))
+        plot.sigXRangeChanged.connect(lambda: self.detail_timer.start())
+        return plot, curve
+
+    def range_changed_manually(self, plot):
+        for row in self.rows:
+            if row['plot'] is plot:
+                self.zoomed.add(row['csvdata'])
+
+    def layout_rows(self):
+        # one row per column of all loaded files (with data mapped), reusing the plot items of the last layout
+        for row in self.rows:
+            self.graph.removeItem(row['plot'])
+            row['plot'].setXLink(None)
+            row['curve'].setData([], [])
+            self.pool.append((row['plot'], row['curve']))
+        self.rows = []
+        for csvdata in self.csvdata:
+            if csvdata.data is None:
+                continue
+            first = None
+            for column in csvdata.columns():
+                plot, curve = self.pool.pop(0) if self.pool else self.create_plot()
+                self.graph.addItem(plot, row=len(self.rows), col=0)
+                plot.setLabel('left', f'<div style="font-size: 10pt">{csvdata.labels[column]}<\\div>')
+                plot.getAxis('bottom').showLabel(False)
+                if first is None:
+                    first = plot
+                else:
+                    plot.setXLink(first)
+                self.rows.append({'plot': plot, 'curve': curve, 'csvdata': csvdata, 'column': column, 'data': False})
+            if first is not None:
+                self.rows[-1]['plot'].setLabel('bottom', f'Samples | File:{csvdata.filename}' \
+                                               if not csvdata.use_first_column_as_x else f'Time | File:{csvdata.filename}')
+        self.graph.setMinimumHeight(ROWHEIGHT * len(self.rows))
+        self.apply_style()
+        self.update_details()
+
+    def apply_style(self):
+        # options that do not need new data: colors and grid
         pg.setConfigOption('background', self.background_color)  # Set the default background color
         pg.setConfigOption('foreground', self.foreground_color)
+        self.graph.setBackground(self.background_color)
+        columns = {}
+        for row in self.rows:
+            i = columns.get(row['csvdata'], 0) # color by column of the file, like before
+            columns[row['csvdata']] = i + 1
+            plot = row['plot']
+            for axis in ('left', 'bottom'):
+                plot.getAxis(axis).setPen(self.foreground_color)
+                plot.getAxis(axis).setTextPen(self.foreground_color)
+            plot.showGrid(x=self.grid_visible, y=self.grid_visible)
+            row['curve'].setPen(self.pen_colors[i % len(self.pen_colors)], width=2)
+
+    def visible_rows(self):
+        # rows inside the visible part of the scroll area
+        top = self.scroll_area.verticalScrollBar().value()
+        bottom = top + self.scroll_area.viewport().height()
+        return [row for row in self.rows
+                if row['plot'].geometry().bottom() >= top and row['plot'].geometry().top() <= bottom]
+
+    def update_details(self):
+        for csvdata in self.csvdata:
+            self.update_detail(csvdata)
+
+    def update_detail(self, csvdata):
+        rows = [row for row in self.rows if row['csvdata'] is csvdata]
+        if csvdata.data is None or not rows: # already closed
+            return
+        if csvdata in self.zoomed:
+            (x0, x1), _ = rows[0]['plot'].viewRange()
+        else: # everything, also while the file is still loading
+            x0 = x1 = None
+        points = 2 * max(1, int(rows[0]['plot'].getViewBox().width()))
+        visible = self.visible_rows()
+        for row in rows:
+            if any(row is other for other in visible):
+                row['curve'].setData(*csvdata.view(row['column'], x0, x1, points))
+                row['data'] = True
+            elif row['data']: # out of sight: no data
+                row['curve'].setData([], [])
+                row['data'] = False
+        if csvdata not in self.zoomed:
+            rows[0]['plot'].setXRange(*csvdata.xrange())
+
+    def close_csvdata(self):
+        self.cancel_loading()
+        for csvdata in self.csvdata:
+            if csvdata not in [loader.csvdata for loader in self.loaders]: # else discarded when the loader stops
+                csvdata.close()
+        self.csvdata = []
+        self.zoomed = set()
+        self.layout_rows()
 
-        # Check if the first row contains column labels
-        if all(isinstance(col, str) for col in data.columns):
-            if self.use_first_column_as_x:
-                x_values = data.iloc[:, 0]
-                data = data.iloc[:, 1:]
-            else:
-                x_values = data.index
-
-            font = pg.QtGui.QFont()
-            font.setPixelSize(11)
-            
-            for i, column in enumerate(data.columns):
-                plotWidget = pg.PlotWidget()
-                plotWidget.setBackground(self.background_color)
-                plotWidget.getAxis('left').setPen(self.foreground_color)
-                plotWidget.getAxis('bottom').setPen(self.foreground_color)
-                plotWidget.showGrid(x=self.grid_visible, y=self.grid_visible)
-                plotWidget.getAxis('left').setStyle(tickFont = font)
-                plotWidget.getAxis('bottom').setStyle(tickFont = font)
-            
-                cplt = plotWidget.plot(x_values, data[column], name=column)
-                cplt.setPen(self.pen_colors[i % len(self.pen_colors)], width=2)
-                plotWidget.setLabel('left', f'<div style="font-size: 10pt">{column}<\div>')
-                if i == len(data.columns) - 1:
-                    plotWidget.setLabel('bottom', f'Samples | File:{self.fileName}' \
-                                        if not self.use_first_column_as_x else f'Time | File:{self.fileName}')
-                    #plotWidget.setLabel('bottom', 'Samples' if not self.use_first_column_as_x else data.columns[0], color=self.foreground_color)
-                self.layout.addWidget(plotWidget)
-                plotWidgets.append(plotWidget)
-        else: # support for non-string column labels
-            for i, column in enumerate(data.columns):
-                plotWidget = pg.PlotWidget()
-                plotWidget.setBackground(self.background_color)
-                plotWidget.getAxis('left').setPen(self.foreground_color)
-                plotWidget.getAxis('bottom').setPen(self.foreground_color)
-                plotWidget.showGrid(x=self.grid_visible, y=self.grid_visible)
-                pen_color = self.pen_colors[i % len(self.pen_colors)]
-                plotWidget.plot(data.index, data[column], pen=pen_color, name=f'Column {i+1}')
-                plotWidget.setLabel('left', f'Column {i+1}', color=self.foreground_color)
-                if i == len(data.columns) - 1:
-                    plotWidget.setLabel('bottom', 'Samples', color=self.foreground_color)
-                self.layout.addWidget(plotWidget)
-                plotWidgets.append(plotWidget)
-
-        # Link all x-axes
-        for plotWidget in plotWidgets[1:]:
-            plotWidget.setXLink(plotWidgets[0])
+    def closeEvent(self, event):
+        self.close_csvdata()
+        for loader in self.loaders:
+            loader.wait()
+            loader.csvdata.discard()
+        event.accept()
 
 if __name__ == '__main__':
     app = pyqtgraph.mkQApp() #QtWidgets.QApplication(sys.argv)
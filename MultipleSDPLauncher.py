@@ -1,9 +1,17 @@
 # Starts up to four instances of the SDP Launcher
 # enables the user to write multiple CSV files with same starting time
 # just provide the config file for each instance and press the button next to it
+# with "Separate processes" (--processes), reading, parsing and CSV writing of every instance run in
+# a process of its own and the windows here only render, see SDP_Remote.py
+# with "Merge recordings" (--merged), all instances write into one time-ordered CSV file instead of
+# one file each, see MergedRecorder in SDP_Recorder.py
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QLabel, QLineEdit
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QFileDialog, QLabel, QLineEdit, QCheckBox
 from SerialDataPlotter import Widget as SerialDataPlotterWidget
+from SDP_Remote import RemoteAcquisition, RemoteRecorder, RemoteBLE
+from SDP_Recorder import MergedRecorder
+from SDP_Filter import outputlabels
+import SDP_Config as SDP
 from qasync import QEventLoop
 import asyncio
 import pyqtgraph
@@ -15,15 +23,37 @@ parser.add_argument('--config1', help='Path to config file for instance 1', defa
 parser.add_argument('--config2', help='Path to config file for instance 2', default=None)
 parser.add_argument('--config3', help='Path to config file for instance 3', default=None)
 parser.add_argument('--config4', help='Path to config file for instance 4', default=None)
+parser.add_argument('--processes', action='store_true', help='Acquisition and recording in separate processes')
+parser.add_argument('--merged', help='Merge the recordings into this CSV file', default=None)
 args = parser.parse_args()
 
 
+class RemoteSDPWidget(SerialDataPlotterWidget):
+    # SerialDataPlotter window that only renders, the device is read by an acquisition process
+    def create_acquisition(self):
+        acquisition = RemoteAcquisition(self.config, self.buffer)
+        self.ble = RemoteBLE(acquisition)
+        return acquisition
+
+    def create_recorder(self, filename):
+        return RemoteRecorder(self.acquisition, filename)
+
+    def source_labels(self):
+        # a recorder of this process gets the samples copied for plotting, see RemoteAcquisition.set_recorder
+        return outputlabels(self.config, self.config['filterplot'])
+
+    def update_plot(self):
+        self.acquisition.poll()
+        super().update_plot()
+
+
 
 class MultipleSDPLauncher(QWidget):
     def __init__(self):
         super().__init__()
         self.initUI()
         self.instances = []
+        self.merger = None  # MergedRecorder while writing a merged file
 
     def initUI(self):
         self.setWindowTitle('Multiple SDP Launcher')
@@ -69,6 +99,18 @@ class MultipleSDPLauncher(QWidget):
         self.csv_button.clicked.connect(self.start_plot_from_0)
         h_layout.addWidget(self.csv_button)
 
+        layout.addLayout(h_layout)
+
+        self.processes_cb = QCheckBox('Separate processes for acquisition and recording')
+        self.processes_cb.setChecked(args.processes)
+        layout.addWidget(self.processes_cb)
+
+        h_layout = QHBoxLayout()
+        self.merged_cb = QCheckBox('Merge recordings into:')
+        self.merged_cb.setChecked(args.merged is not None)
+        h_layout.addWidget(self.merged_cb)
+        self.merged_le = QLineEdit(args.merged if args.merged else '<home>/Documents/merged_<date>_<time>.csv')
+        h_layout.addWidget(self.merged_le)
         layout.addLayout(h_layout)
         self.setLayout(layout)
     
@@ -88,7 +130,10 @@ class MultipleSDPLauncher(QWidget):
         for edit in self.config_edits:
             config = edit.text()
             if config and config != f'Config {self.config_edits.index(edit)+1}: Not selected':
-                instance = SerialDataPlotterWidget(config_file=config)
+                if self.processes_cb.isChecked():
+                    instance = RemoteSDPWidget(config_file=config)
+                else:
+                    instance = SerialDataPlotterWidget(config_file=config)
                 instance.show()
                 self.instances.append(instance)
         # get screen geometry, window geometry and frame geometry to calculate window sizes and positions
@@ -126,11 +171,37 @@ class MultipleSDPLauncher(QWidget):
         for instance in self.instances:
             instance.close()
         self.instances = []
+        if self.merger is not None:
+            self.merger.close()
+            self.merger = None
 
     def toggle_csv_writing(self):
+        if self.merger is not None or (self.merged_cb.isChecked() and not any(i.recorder for i in self.instances)):
+            self.toggle_merged_writing()
+            return
         for instance in self.instances:
             instance.write_to_csv()
 
+    def toggle_merged_writing(self):
+        if self.merger is None and self.instances:
+            filename = SDP.expandpath(self.merged_le.text())
+            sources = [(F"{i+1}: {instance.config['title']}", instance.source_labels(), instance.config['samplerate']) for i, instance in enumerate(self.instances)]
+            try:
+                self.merger = MergedRecorder(filename, sources, maxdelay=1.0,
+                                             flushinterval=self.instances[0].config['csvflushinterval'],
+                                             buffersize=self.instances[0].config['csvbuffersize'])
+            except OSError as e:
+                print(F'Error writing to {filename}: {e}')
+                return
+            for i, instance in enumerate(self.instances):
+                if not instance.start_writing(filename, self.merger.source(i)):
+                    self.merger.close_source(i) # would hold back the others
+        elif self.merger is not None:
+            for instance in self.instances: # closes their sources
+                instance.stop_writing()
+            self.merger.close() # also if a source was not closed, writes everything held back
+            self.merger = None
+
 if __name__ == '__main__':
     #app = QApplication(sys.argv)
     app = pyqtgraph.mkQApp()
@@ -0,0 +1,215 @@
+# Project: Serial Data Plotter
+# acquisition worker for SerialDataPlotter.py
+#
+# reading, parsing, storing and recording of samples run in their own thread, so a
+# slow repaint, a window drag or a BLE scan in the GUI thread never stalls acquisition.
+# the worker owns the transport (serial port, socket, pipe, see SDP_Transport.py, BLE
+# notifications are queued by feed()) and writes into the shared RingBuffer, the GUI only
+# reads the buffer.
+# everything meant for the terminal log goes through bounded single-producer/single-consumer
+# queues that the GUI drains at its refresh rate (get_log()): one for this thread, one for the
+# thread controlling it (the GUI thread with the asyncio loop, or SDP_Headless.py).
+#
+# the counters in stats() are the proof that no samples were lost: every received
+# line is either parsed into a sample or counted as malformed, independent of the GUI thread.
+# "samples" counts the parsed ones, with "decimate" filters fewer are stored (SDP_Filter.py).
+# every read (BLE notification) is timestamped on arrival for the latency stats, see SDP_Latency.
+# raw data and malformed lines for the terminal are limited to "lograte" lines per second,
+# the rest is only counted (stats()['suppressed']) and reported once per second.
+# derived channels (SDP_Derived.py) and the "filters" of the channels (SDP_Filter.py) run here
+# too, right after parsing.
+
+from collections import deque
+import threading
+import time
+from PyQt5 import QtCore
+
+from SDP_Parser import getparser
+from SDP_Derived import DerivedChannels
+from SDP_Filter import FilterBank
+from SDP_Transport import gettransport
+from SDP_Latency import LatencyStats
+
+
+class SPSCQueue:
+    # bounded queue for exactly one producer and one consumer thread.
+    # deque.append and deque.popleft are atomic, so no lock is needed.
+    # put never blocks the producer: if the queue is full, the item is dropped and counted.
+    def __init__(self, maxsize):
+        self.items = deque()
+        self.maxsize = maxsize
+        self.dropped = 0
+
+    def put(self, item):
+        if len(self.items) >= self.maxsize:
+            self.dropped += 1
+            return False
+        self.items.append(item)
+        return True
+
+    def get_all(self):
+        items = []
+        for _ in range(len(self.items)):
+            items.append(self.items.popleft())
+        return items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class RateLimiter:
+    # token bucket: at most <rate> items per second, bursts up to one second's worth. rate 0: no limit
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def take(self, n):
+        # returns how many of <n> items may pass
+        if not self.rate:
+            return n
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        allowed = min(n, int(self.tokens))
+        self.tokens -= allowed
+        return allowed
+
+
+class AcquisitionWorker(QtCore.QThread):
+    def __init__(self, config, buffer=None, parent=None):
+        super().__init__(parent)
+        self.config = config
+        self.buffer = buffer    # RingBuffer for plotting, None for recording only (SDP_Headless.py)
+        self.lock = threading.Lock() if buffer is None else buffer.lock
+        self.parser = getparser(config)
+        self.derived = DerivedChannels(config)
+        self.filters = FilterBank(config)
+        self.transport = None   # SDP_Transport.Transport, used by this thread only while running
+        self.recorder = None    # CSVRecorder, set and closed by the GUI with set_recorder()
+        self.showraw = False    # copy every received line to the terminal log
+        self.holdreplay = False # a replay pauses at its end instead of ending (the GUI replay controls)
+        self.running = False
+        self.wakeup = threading.Event()
+        self.incoming = SPSCQueue(100000) # BLE notifications (arrival time, bytes) from the asyncio loop
+        self.outgoing = SPSCQueue(1000)   # commands (bytes) for the serial port
+        self.log = SPSCQueue(10000)       # lines for the terminal log, from this thread
+        self.controllog = SPSCQueue(1000) # lines for the terminal log, from the controlling thread
+        self.lines = 0          # received lines
+        self.samples = 0        # parsed samples (lines with valid data), before decimation
+        self.malformed = 0      # lines without (enough) valid data
+        self.loglimit = RateLimiter(config['lograte'])
+        self.suppressed = 0     # log lines not shown because of "lograte"
+        self.reported = 0       # suppressed lines already reported in the log
+        self.lastreport = 0.0
+        self.latency = LatencyStats(render=buffer is not None)
+
+    def open_transport(self, address):
+        # opens the transport for "com" = <address> and starts reading it. False if it can't be opened
+        try:
+            transport = gettransport(address, self)
+            transport.open()
+        except OSError as e:
+            self.controllog.put(F"[-PC-] Error: {e}")
+            return False
+        self.start_transport(transport)
+        return True
+
+    def start_ble(self):
+        # the BLE connection is made in the asyncio loop, the notifications come in through feed()
+        self.start_transport(gettransport("Address", self))
+
+    def start_transport(self, transport):
+        self.filters.reset()
+        self.transport = transport
+        self.transport.attach(self)
+        self.running = True
+        self.start()
+
+    def stop(self):
+        self.running = False
+        self.wakeup.set()
+        self.wait()
+
+    def feed(self, data):
+        # called for every BLE notification
+        if not self.incoming.put((time.perf_counter(), bytes(data))):
+            self.controllog.put('[-PC-] Error: receive queue full, BLE data dropped')
+        self.wakeup.set()
+
+    def write(self, data):
+        if not self.outgoing.put(data):
+            self.controllog.put('[-PC-] Error: send queue full, command dropped')
+
+    def set_recorder(self, recorder):
+        with self.lock: # make sure no batch is being stored while the recorder is changed
+            self.recorder = recorder
+
+    def run(self):
+        while self.running:
+            for data in self.outgoing.get_all():
+                try:
+                    self.transport.write(data)
+                except OSError as e:
+                    self.log.put(F"[-PC-] Error: command not sent, {e}")
+            try:
+                chunks = self.transport.read(0.02)
+            except OSError as e:
+                self.log.put(F"[-PC-] Error: {e}")
+                break
+            except EOFError as e: # the end of a replay
+                self.log.put(F"[-PC-] {e}")
+                break
+            for arrival, data in chunks:
+                self.process(self.parser.packet(data) if self.transport.packets else self.parser.split(data), arrival)
+        self.transport.close()
+        self.transport = None
+        self.report_suppressed(force=True)
+        self.running = False
+
+    def process(self, lines, arrival):
+        # lines: text lines or binary frames, see SDP_Parser. arrival: time.perf_counter() of the read
+        if not len(lines) and not self.parser.skipped:
+            return
+        if self.showraw and len(lines):
+            self.put_log(lines, self.parser.rawtext)
+        values, malformed = self.parser.parse(lines)
+        values = self.derived.process(values) # the same rows if there are no derived channels
+        plotted, recorded = self.filters.process(values) # the same rows if there are no filters
+        with self.lock:
+            if self.buffer is not None:
+                self.buffer.write(plotted)
+            if self.recorder is not None and len(recorded):
+                self.recorder.put(recorded)
+            stored = len(plotted) if self.buffer is not None else len(recorded) # after decimation
+            if stored:
+                self.latency.stored(arrival, stored)
+        self.lines += len(lines)
+        self.samples += len(values)
+        if malformed: # either no float or not (enough) data: just throw to terminal log.
+            self.malformed += len(malformed)
+            self.put_log(malformed, '\n'.join)
+        self.report_suppressed()
+
+    def put_log(self, lines, totext):
+        # the first lines up to the rate limit go to the terminal log, as one text
+        allowed = self.loglimit.take(len(lines))
+        if allowed:
+            self.log.put(totext(lines[:allowed]))
+        self.suppressed += len(lines) - allowed
+
+    def report_suppressed(self, force=False):
+        if self.suppressed > self.reported and (force or time.monotonic() - self.lastreport >= 1.0):
+            self.log.put(F'[-PC-] {self.suppressed - self.reported} lines not shown '
+                         F'(more than {self.config["lograte"]} lines/s, see "lograte")')
+            self.reported = self.suppressed
+            self.lastreport = time.monotonic()
+
+    def get_log(self):
+        # controlling thread: the new lines for the terminal log
+        return self.controllog.get_all() + self.log.get_all()
+
+    def stats(self):
+        return {'lines': self.lines, 'samples': self.samples, 'malformed': self.malformed,
+                'incoming': len(self.incoming), 'dropped': self.incoming.dropped,
+                'logdropped': self.log.dropped + self.controllog.dropped, 'suppressed': self.suppressed}
@@ -1,87 +1,215 @@
+# BLE (Nordic UART service) connection for SerialDataPlotter.py, plain asyncio without Qt,
+# so it can also be used by SDP_Headless.py. the scanner window is in SDP_BLEScanner.py
+#
+# all BLE objects of a process (one per Widget, e.g. in MultipleSDPLauncher.py) share one
+# BLEManager on the one asyncio loop: it serializes scans and connects (several at once upset
+# most BLE stacks), knows the open sessions and keeps a scan cache, so connects and reconnects
+# get the BLEDevice without a new scan (BleakClient scans itself if it only gets an address).
+# the first connect gets CONNECTATTEMPTS attempts, a lost connection is reconnected automatically,
+# both with exponential backoff.
 import asyncio
-from qasync import asyncSlot
+import time
 from bleak import BleakScanner, BleakClient
-from PyQt5 import QtCore, QtWidgets
 import datetime
 
-class BLE:
+SCANTTL = 60.0          # seconds scan results are reused
+SCANTIMEOUT = 5.0       # seconds per scan
+RECONNECTDELAY = 0.5    # seconds before the first reconnect attempt, doubled after every failure
+MAXRECONNECTDELAY = 30.0
+CONNECTATTEMPTS = 3     # of connect_to_device()
+
+
+class ScanCache:
+    def __init__(self, ttl=SCANTTL):
+        self.ttl = ttl
+        self.devices = {}   # address -> (BLEDevice, time.monotonic() when seen)
+        self.lastscan = None
+
+    async def scan(self, timeout=SCANTIMEOUT):
+        for device in await BleakScanner.discover(timeout=timeout):
+            self.devices[device.address] = (device, time.monotonic())
+        self.lastscan = time.monotonic()
+
+    async def get_devices(self, refresh=False):
+        # all devices seen within ttl, scans only if the last scan is older
+        if refresh or self.lastscan is None or time.monotonic() - self.lastscan > self.ttl:
+            await self.scan()
+        now = time.monotonic()
+        return [device for device, seen in self.devices.values() if now - seen <= self.ttl]
+
+    async def find(self, address):
+        # BLEDevice for address, from the cache if seen within ttl, None if not found
+        entry = self.devices.get(address)
+        if entry is not None and time.monotonic() - entry[1] <= self.ttl:
+            return entry[0]
+        device = await BleakScanner.find_device_by_address(address, timeout=SCANTIMEOUT)
+        if device is not None:
+            self.devices[address] = (device, time.monotonic())
+        return device
+
+    def forget(self, address):
+        # after a failed connect: the cached BLEDevice may be stale
+        self.devices.pop(address, None)
+
+
+class BLEManager:
     def __init__(self):
+        self.scancache = ScanCache()
+        self.lock = asyncio.Lock()  # one scan or connect at a time
+        self.sessions = {}          # address -> connected or reconnecting BLE
+
+    async def get_devices(self, refresh=False):
+        async with self.lock:
+            return await self.scancache.get_devices(refresh)
+
+
+manager = BLEManager()  # shared by all BLE objects of the process
+
+
+class BLE:
+    def __init__(self, manager=manager):
+        self.manager = manager
         self.client = None
+        self.address = None
+        self.receiver = None
+        self.closing = False        # disconnect() was called, no reconnect
+        self.reconnecting = None    # task of the reconnect loop
+        self.reconnects = 0
         self.nus_service_uuid = "6e400001-b5a3-f393-e0a9-e50e24dcca9e"
         self.rx_char_uuid = "6e400003-b5a3-f393-e0a9-e50e24dcca9e"
         self.tx_char_uuid = "6e400002-b5a3-f393-e0a9-e50e24dcca9e"
+        self.tx_char = None         # characteristic for send_data, found on connect
+        self.write_response = True  # False if the device supports write without response (faster)
+        self.write_size = 20        # bytes per write, depends on the negotiated MTU
 
-    @asyncSlot()
-    async def scan_for_devices(self):
-        devices = await BleakScanner.discover()
+    async def scan_for_devices(self, refresh=False):
+        devices = await self.manager.get_devices(refresh)
         for device in devices:
             print(f"Found device: {device.name}, {device.address}")
         return devices
     
-    @asyncSlot(str)
     async def connect_to_device(self, address,receiver):
-        self.client = BleakClient(address)
-        try:
-            await self.client.connect()
-            print(f"Connected to {address}")
-            await self.client.start_notify(self.rx_char_uuid, receiver)
-        except Exception as e:
-            print(f"Failed to connect: {e}")
-            self.client = None
+        # True if connected, False if the address is used by another BLE object or all attempts failed
+        session = self.manager.sessions.get(address)
+        if session is not None and session is not self:
+            print(f"Failed to connect: {address} is already connected")
+            return False
+        self.address = address
+        self.receiver = receiver
+        self.closing = False
+        if not await self.connect() and not await self.retry(CONNECTATTEMPTS - 1):
+            return False
+        self.manager.sessions[address] = self
+        return True
+
+    async def connect(self):
+        # one connect attempt, True if connected
+        async with self.manager.lock:
+            connected = None
+            try:
+                device = await self.manager.scancache.find(self.address)
+                client = BleakClient(device if device is not None else self.address,
+                                     disconnected_callback=self.on_disconnect)
+                await client.connect()
+                connected = client
+                if self.closing: # disconnect() was called meanwhile, it found no client to disconnect
+                    await self.abandon(connected)
+                    return False
+                self.client = client
+                await self.negotiate_mtu()
+                print(f"Connected to {self.address}, MTU {self.client.mtu_size}, "
+                      f"{'write with' if self.write_response else 'write without'} response")
+                await self.client.start_notify(self.rx_char_uuid, self.receiver)
+                return True
+            except asyncio.CancelledError: # e.g. the reconnect loop, cancelled by disconnect()
+                await self.abandon(connected)
+                raise
+            except Exception as e:
+                print(f"Failed to connect to {self.address}: {e}")
+                self.manager.scancache.forget(self.address)
+                await self.abandon(connected)
+                return False
+
+    async def abandon(self, client):
+        # disconnects a client that is not used, without a reconnect from on_disconnect
+        self.client = None
+        if client is not None:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+
+    def on_disconnect(self, client):
+        # bleak callback, also called after disconnect()
+        if self.closing or client is not self.client:
+            return
+        print(f"Connection to {self.address} lost, reconnecting")
+        self.client = None
+        if self.reconnecting is None or self.reconnecting.done():
+            self.reconnecting = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        if await self.retry():
+            self.reconnects += 1
+            print(f"Reconnected to {self.address} ({self.reconnects} reconnects)")
+
+    async def retry(self, attempts=None):
+        # connect attempts with exponential backoff until connected (True), disconnect() or <attempts> failed
+        delay = RECONNECTDELAY
+        while not self.closing and attempts != 0:
+            await asyncio.sleep(delay)
+            if self.closing:
+                break
+            if await self.connect():
+                return True
+            if attempts is not None:
+                attempts -= 1
+            delay = min(delay * 2, MAXRECONNECTDELAY)
+        return False
+
+    async def negotiate_mtu(self):
+        # Windows and macOS negotiate the largest MTU on connect, BlueZ reports 23 until it is acquired.
+        # BlueZ only: the private _acquire_mtu() is what the bleak docs (mtu_size) recommend for it,
+        # bleak >= 0.19, tested with 3.0. without it, mtu_size is used as reported
+        backend = getattr(self.client, '_backend', None)
+        if type(backend).__name__ == 'BleakClientBlueZDBus' and hasattr(backend, '_acquire_mtu'):
+            try:
+                await backend._acquire_mtu()
+            except Exception as e:
+                print(f"Could not acquire MTU: {e}")
+        if self.client.mtu_size <= 23:
+            print(f"MTU of {self.address} is {self.client.mtu_size} (the minimum), writes of 20 bytes")
+        self.tx_char = self.client.services.get_characteristic(self.tx_char_uuid)
+        self.write_response = self.tx_char is None or 'write-without-response' not in self.tx_char.properties
+        if self.write_response:
+            self.write_size = max(20, self.client.mtu_size - 3)
+        else:
+            self.write_size = self.tx_char.max_write_without_response_size
 
-    @asyncSlot()
     async def disconnect(self):
+        self.closing = True
+        if self.reconnecting is not None:
+            self.reconnecting.cancel()
+            self.reconnecting = None
+        if self.manager.sessions.get(self.address) is self:
+            del self.manager.sessions[self.address]
         if self.client:
             await self.client.disconnect()
+            self.client = None
             print("Disconnected")
 
-    @asyncSlot(str)
     async def send_data(self, data):
+        # in writes of at most write_size bytes, without response if the device supports it
         if self.client:
-            await self.client.write_gatt_char(self.tx_char_uuid, data)
+            for i in range(0, len(data), self.write_size):
+                await self.client.write_gatt_char(self.tx_char or self.tx_char_uuid, data[i:i + self.write_size],
+                                                  response=self.write_response)
             #print(f"Sent data: {data}")
 
     def notification_handler(self, sender, data):
         print(f"Received data: {data}")
 
 
-class BLEScannerWindow(QtWidgets.QWidget):
-    device_selected = QtCore.pyqtSignal(str)
-
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("BLE Device Scanner")
-        self.setGeometry(100, 100, 400, 300)
-
-        self.layout = QtWidgets.QVBoxLayout(self)
-
-        self.device_list = QtWidgets.QListWidget(self)
-        self.layout.addWidget(self.device_list)
-
-        self.scan_button = QtWidgets.QPushButton("Scan for Devices", self)
-        self.scan_button.clicked.connect(self.scan_for_devices)
-        self.layout.addWidget(self.scan_button)
-
-        self.select_button = QtWidgets.QPushButton("Select Device", self)
-        self.select_button.clicked.connect(self.select_device)
-        self.layout.addWidget(self.select_button)
-
-    @asyncSlot()
-    async def scan_for_devices(self):
-        self.device_list.clear()
-        devices = await BleakScanner.discover()
-        for device in devices:
-            self.device_list.addItem(f"{device.name} ({device.address})")
-
-    def select_device(self):
-        selected_item = self.device_list.currentItem()
-        if selected_item:
-            device_address = selected_item.text().split('(')[-1].strip(')')
-            self.device_selected.emit(device_address)
-            self.close()
-
-
-
 # Example usage
 async def main():
     ble = BLE()
@@ -97,7 +225,7 @@ async def main():
             print("No device with name containing 'Feather' found")
             return
         #address = devices[0].address  # Replace with the desired device address
-        await ble.connect_to_device(address)
+        await ble.connect_to_device(address, ble.notification_handler)
         await asyncio.sleep(30)  # Keep the connection for 10 seconds
         await ble.disconnect()
 
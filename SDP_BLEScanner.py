@@ -0,0 +1,46 @@
+# window to scan for BLE devices, for SerialDataPlotter.py
+# shows the devices of the scan cache (SDP_BLE.ScanCache), "Rescan" scans again
+from qasync import asyncSlot
+from PyQt5 import QtCore, QtWidgets
+
+import SDP_BLE as BLE
+
+
+class BLEScannerWindow(QtWidgets.QWidget):
+    device_selected = QtCore.pyqtSignal(str)
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("BLE Device Scanner")
+        self.setGeometry(100, 100, 400, 300)
+
+        self.layout = QtWidgets.QVBoxLayout(self)
+
+        self.device_list = QtWidgets.QListWidget(self)
+        self.layout.addWidget(self.device_list)
+
+        self.scan_button = QtWidgets.QPushButton("Scan for Devices", self)
+        self.scan_button.clicked.connect(lambda: self.scan_for_devices(False))
+        self.layout.addWidget(self.scan_button)
+
+        self.rescan_button = QtWidgets.QPushButton("Rescan", self)
+        self.rescan_button.clicked.connect(lambda: self.scan_for_devices(True))
+        self.layout.addWidget(self.rescan_button)
+
+        self.select_button = QtWidgets.QPushButton("Select Device", self)
+        self.select_button.clicked.connect(self.select_device)
+        self.layout.addWidget(self.select_button)
+
+    @asyncSlot(bool)
+    async def scan_for_devices(self, refresh):
+        self.device_list.clear()
+        devices = await BLE.manager.get_devices(refresh)
+        for device in devices:
+            self.device_list.addItem(f"{device.name} ({device.address})")
+
+    def select_device(self):
+        selected_item = self.device_list.currentItem()
+        if selected_item:
+            device_address = selected_item.text().split('(')[-1].strip(')')
+            self.device_selected.emit(device_address)
+            self.close()
@@ -0,0 +1,220 @@
+# Project: Serial Data Plotter
+# end-to-end throughput benchmark with the device simulator (SDP_Simulator.py), Linux only
+#
+# drives the real ingestion path: pty -> AcquisitionWorker (serial) or FakeBLE notifications
+# -> Widget.receive (BLE), parsing, RingBuffer, CSV recording and the timer driven update_plot
+# of a real Widget (or SDP_Headless.HeadlessRecorder with --headless).
+# for every rate the simulator sends for --duration seconds, then the plotter gets --drain
+# seconds to catch up. the results (one record per rate) are written as JSON to --output,
+# together with the git commit, so regressions can be tracked across versions:
+#   offered/sustained samples per second, sent/received/stored/malformed/dropped samples,
+#   lost samples, frames and frame cost (mean, p95, max in ms), timer interval, max. RSS,
+#   latency arrival -> parse -> render (see SDP_Latency.py)
+#
+# e.g.: python SDP_Benchmark.py --rates 1000 10000 100000 --duration 10 --output results.json
+#       python SDP_Benchmark.py --config binary.json --transport ble --offscreen
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import SDP_Config as SDP
+from SDP_Simulator import Simulator, FakeBLE
+
+
+def gitversion():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def maxrss():
+    # maximum resident set size of this process in MB (ru_maxrss is in kB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Benchmark:
+    def __init__(self, config, transport='serial', headless=False, duration=10.0, drain=2.0, malformed=0.0, mtu=247):
+        self.config = config
+        self.mtu = mtu
+        self.transport = transport
+        self.headless = headless
+        self.duration = duration
+        self.drain = drain
+        self.malformed = malformed
+        self.csvfile = os.path.join(tempfile.mkdtemp(prefix='sdp_benchmark_'), 'benchmark.csv')
+
+    async def run(self, rate):
+        simulator = Simulator(self.config, rate, self.malformed)
+        if self.transport == 'ble':
+            self.config['com'] = 'Address simulator'
+        else:
+            self.config['com'] = simulator.open_pty()
+        self.config['csvpath'] = self.csvfile
+        if self.headless:
+            result = await self.run_headless(simulator)
+        else:
+            result = await self.run_widget(simulator)
+        simulator.close()
+        os.remove(self.csvfile)
+        result.update({
+            'rate': rate,
+            'sent': simulator.sent,
+            'bytes': simulator.bytes_sent,
+            'lost': simulator.sent - result['samples'] - result['malformed'],
+            'maxrss_mb': round(maxrss(), 1),
+        })
+        return result
+
+    async def run_headless(self, simulator):
+        from SDP_Headless import HeadlessRecorder
+        recorder = HeadlessRecorder(self.config)
+        if self.transport == 'ble':
+            recorder.ble = FakeBLE(simulator, self.mtu)
+        if not await recorder.connect() or not await recorder.start_csv():
+            raise RuntimeError(F'could not connect to {self.config["com"]}')
+        if self.transport == 'serial':
+            simulator.start()
+        await asyncio.sleep(self.duration)
+        simulator.running = False
+        elapsed = time.monotonic() - simulator.started
+        await asyncio.sleep(self.drain)
+        await recorder.stop()
+        return self.acquisition_result(recorder.acquisition, elapsed)
+
+    async def run_widget(self, simulator):
+        from SerialDataPlotter import Widget
+        configfile = os.path.join(os.path.dirname(self.csvfile), 'config.json')
+        with open(configfile, 'w') as f:
+            json.dump(self.config, f)
+        w = Widget(config_file=configfile)
+        if self.transport == 'ble':
+            w.ble = FakeBLE(simulator, self.mtu)
+        w.comport_le.setText(self.config['com'])
+        w.csvpath_le.setText(self.csvfile)
+        w.show()
+        frames = []     # (update_plot duration in ms, drawn) of every timer tick
+        intervals = []
+        def frame():
+            frames.append((w.render.lastcost, w.render.lastdirty))
+            intervals.append(w.render.interval)
+        w.timer.timeout.connect(frame) # connected after update_plot, so it runs right after it
+        w.connect_btn.setChecked(True)
+        await asyncio.sleep(0.2)
+        if not w.connected:
+            raise RuntimeError(F'could not connect to {self.config["com"]}')
+        w.write_to_csv()
+        if self.transport == 'serial':
+            simulator.start()
+        await asyncio.sleep(self.duration)
+        simulator.running = False
+        elapsed = time.monotonic() - simulator.started
+        await asyncio.sleep(self.drain)
+        w.write_to_csv()
+        w.connect_btn.setChecked(False)
+        await asyncio.sleep(0.2)
+        w.timer.timeout.disconnect(frame)
+        result = self.acquisition_result(w.acquisition, elapsed)
+        drawn = np.array([cost for cost, dirty in frames if dirty])
+        result.update({
+            'frames': len(frames),
+            'frames_drawn': len(drawn),
+            'frame_ms_mean': round(float(drawn.mean()), 3) if len(drawn) else None,
+            'frame_ms_p95': round(float(np.percentile(drawn, 95)), 3) if len(drawn) else None,
+            'frame_ms_max': round(float(drawn.max()), 3) if len(drawn) else None,
+            'interval_ms_mean': round(float(np.mean(intervals)), 1) if intervals else None,
+        })
+        w.close()
+        return result
+
+    def acquisition_result(self, acquisition, elapsed):
+        stats = acquisition.stats()
+        return {
+            'elapsed': round(elapsed, 3),
+            'lines': stats['lines'],
+            'samples': stats['samples'],
+            'malformed': stats['malformed'],
+            'dropped': stats['dropped'],
+            'logdropped': stats['logdropped'],
+            'suppressed': stats['suppressed'],
+            'throughput': round(stats['samples'] / elapsed, 1),
+            'latency': acquisition.latency.summary(),
+        }
+
+
+async def main(args, config):
+    benchmark = Benchmark(config, args.transport, args.headless, args.duration, args.drain, args.malformed, args.mtu)
+    results = []
+    for rate in args.rates:
+        result = await benchmark.run(rate)
+        print(F"{rate:g} samples/s offered: {result['throughput']:.0f} samples/s stored, "
+              F"{result['lost']} lost, {result['malformed']} malformed, {result['maxrss_mb']} MB", flush=True)
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput benchmark with simulated devices')
+    parser.add_argument("--config", help="config file (plots, samples, format, ...)", default=None)
+    parser.add_argument("--plots", type=int, help="Number of channels", default=None)
+    parser.add_argument("--samples", type=int, help="Number of samples per plot", default=None)
+    parser.add_argument("--rates", type=float, nargs='+', help="samples per second to test, 0: as fast as possible",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--duration", type=float, help="seconds per rate", default=10.0)
+    parser.add_argument("--drain", type=float, help="seconds to catch up after sending", default=2.0)
+    parser.add_argument("--malformed", type=float, help="fraction of corrupted records", default=0.0)
+    parser.add_argument("--transport", choices=['serial', 'ble'], default='serial')
+    parser.add_argument("--mtu", type=int, help="MTU of the simulated BLE connection", default=247)
+    parser.add_argument("--headless", action='store_true', help="SDP_Headless instead of the GUI")
+    parser.add_argument("--offscreen", action='store_true', help="render without display (QT_QPA_PLATFORM=offscreen)")
+    parser.add_argument("--output", help="JSON file for the results", default='benchmark.json')
+
+    args = parser.parse_args()
+    config = SDP.loadconfig(args.config)
+    if args.plots is not None:
+        config['plots'] = args.plots
+    if args.samples is not None:
+        config['samples'] = args.samples
+    if args.offscreen:
+        os.environ['QT_QPA_PLATFORM'] = 'offscreen'
+
+    if args.headless:
+        from PyQt5 import QtCore
+        app = QtCore.QCoreApplication(sys.argv)
+        results = asyncio.run(main(args, config))
+    else:
+        import pyqtgraph
+        from qasync import QEventLoop
+        app = pyqtgraph.Qt.mkQApp()
+        loop = QEventLoop(app)
+        asyncio.set_event_loop(loop)
+        with loop:
+            results = loop.run_until_complete(main(args, config))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'version': gitversion(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'transport': args.transport,
+            'mtu': args.mtu if args.transport == 'ble' else None,
+            'headless': args.headless,
+            'format': config['format'],
+            'plots': config['plots'],
+            'samples': config['samples'],
+            'duration': args.duration,
+            'results': results,
+        }, f, indent=4)
+    print(F'Results written to {args.output}')
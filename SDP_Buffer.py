@@ -0,0 +1,142 @@
+# Project: Serial Data Plotter
+# sample buffer for SerialDataPlotter.py
+#
+# one preallocated, contiguous float array (channels x samples) and a write cursor.
+# the plot is drawn "sweep style" like an oscilloscope: new samples overwrite the
+# oldest ones at the cursor position, so each row can be handed to pyqtgraph as is
+# (no copy, no list to array conversion)
+
+import threading
+import numpy as np
+
+
+class RingBuffer:
+    def __init__(self, channels, samples, dtype=np.float64):
+        self.channels = channels
+        self.samples = samples
+        self.data = np.zeros((channels, samples), dtype=dtype)
+        self.idx = 0        # next write position
+        self.written = 0    # total number of samples written, never wraps
+        self.summaries = [] # BlockSummary objects kept up to date on every write
+        self.lock = threading.Lock() # held by the writing thread during write(), by readers while they query
+
+    def write(self, values):
+        # values: one sample for every channel (1d) or a batch of samples (rows x channels)
+        values = np.asarray(values, dtype=self.data.dtype)
+        if values.ndim == 1:
+            values = values.reshape(1, -1)
+        n = values.shape[0]
+        if n == 0:
+            return
+        if n > self.samples: # only the newest samples fit, skip the rest but keep the cursor consistent
+            skip = n - self.samples
+            self.idx = (self.idx + skip) % self.samples
+            self.written += skip
+            values = values[skip:]
+            n = self.samples
+        end = self.idx + n
+        if end <= self.samples:
+            self.data[:, self.idx:end] = values.T
+            ranges = [(self.idx, end)]
+        else: # wrap around
+            first = self.samples - self.idx
+            self.data[:, self.idx:] = values[:first].T
+            self.data[:, :end - self.samples] = values[first:].T
+            ranges = [(self.idx, self.samples), (0, end - self.samples)]
+        self.idx = end % self.samples
+        self.written += n
+        for summary in self.summaries:
+            for start, stop in ranges:
+                summary.update(start, stop)
+
+    def latest(self, n):
+        # copy of the newest n samples of every channel (channels x n), oldest first
+        n = min(n, self.samples, self.written)
+        start = self.idx - n
+        if start >= 0:
+            return self.data[:, start:self.idx].copy()
+        return np.hstack((self.data[:, start:], self.data[:, :self.idx]))
+
+    def last(self):
+        # most recent sample of every channel
+        return self.data[:, self.idx - 1]
+
+    def reset(self):
+        # start plotting from 0 again, old samples stay visible until overwritten
+        self.idx = 0
+
+    def add_summary(self, block):
+        summary = BlockSummary(self, block)
+        self.summaries.append(summary)
+        return summary
+
+    def remove_summary(self, summary):
+        self.summaries.remove(summary)
+
+
+class BlockSummary:
+    # min/max of every block of <block> consecutive samples of a RingBuffer.
+    # a write only recomputes the blocks it touched, so the min/max of any window
+    # comes from (window/block) block values plus two partial blocks at the edges
+    # instead of a scan over all samples in the window.
+    def __init__(self, buffer, block):
+        self.buffer = buffer
+        self.block = max(1, int(block))
+        self.starts = np.arange(0, buffer.samples, self.block) # first sample of every block
+        self.min = np.minimum.reduceat(buffer.data, self.starts, axis=1)
+        self.max = np.maximum.reduceat(buffer.data, self.starts, axis=1)
+        self.cache = None   # last window query, valid as long as nothing was written
+
+    def update(self, start, stop):
+        # samples [start, stop) changed
+        first = start // self.block
+        last = (stop - 1) // self.block + 1
+        segment = self.buffer.data[:, first*self.block:min(last*self.block, self.buffer.samples)]
+        offsets = self.starts[first:last] - first*self.block
+        self.min[:, first:last] = np.minimum.reduceat(segment, offsets, axis=1)
+        self.max[:, first:last] = np.maximum.reduceat(segment, offsets, axis=1)
+        self.cache = None
+
+    def envelope(self, first, last):
+        # min/max pairs of the blocks [first, last), ready to plot: spikes stay visible at any zoom level
+        # x: (2*blocks) start sample of every block, twice; y: (channels x 2*blocks) min, max, min, max...
+        first = max(0, first)
+        last = min(len(self.starts), last)
+        x = np.repeat(self.starts[first:last], 2)
+        y = np.empty((self.buffer.channels, len(x)))
+        y[:, 0::2] = self.min[:, first:last]
+        y[:, 1::2] = self.max[:, first:last]
+        return x, y
+
+    def window(self, length):
+        # min and max of every channel over the newest <length> samples (wrapping around)
+        length = min(length, self.buffer.samples)
+        key = (self.buffer.idx, length)
+        if self.cache is not None and self.cache[0] == key:
+            return self.cache[1]
+        stop = self.buffer.idx
+        start = stop - length
+        if start >= 0:
+            ranges = [(start, stop)]
+        else:
+            ranges = [(start + self.buffer.samples, self.buffer.samples), (0, stop)]
+        mins = []
+        maxs = []
+        for start, stop in ranges:
+            if stop <= start:
+                continue
+            first = -(-start // self.block)   # first full block
+            last = stop // self.block         # end of the last full block
+            if first < last:
+                mins.append(self.min[:, first:last].min(axis=1))
+                maxs.append(self.max[:, first:last].max(axis=1))
+                edges = [(start, first*self.block), (last*self.block, stop)]
+            else:
+                edges = [(start, stop)]
+            for a, b in edges:
+                if a < b:
+                    mins.append(self.buffer.data[:, a:b].min(axis=1))
+                    maxs.append(self.buffer.data[:, a:b].max(axis=1))
+        result = (np.min(mins, axis=0), np.max(maxs, axis=0))
+        self.cache = (key, result)
+        return result
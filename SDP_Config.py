@@ -1,7 +1,28 @@
 # Project: Serial Data Plotter
 # provides default config for SerialDataPlotter.py
 
+import datetime
 import json
+import os
+
+def loadconfig(file):
+    # config from file, default config if there is no file or it can't be read
+    if file:
+        try:
+            return parseconfig(file)
+        except (json.JSONDecodeError, FileNotFoundError) as e:
+            print(f'Error reading config file "{file}": {e}. Using default config.')
+    return getdefaultconfig()
+
+def expandcommand(command):
+    # <date> and <time> in commands sent to the device
+    now = datetime.datetime.now()
+    return command.replace('<date>', now.strftime('%Y-%m-%d')).replace('<time>', now.strftime('%H-%M-%S'))
+
+def expandpath(csvpath):
+    # <home>, <date> and <time> in "csvpath"
+    return expandcommand(csvpath.replace('<home>', os.path.expanduser('~'))) \
+           .replace('/', os.sep)  # for windows compatibility
 
 def parseconfig(file):
     # parse the config file
@@ -28,9 +49,29 @@ def getdefaultconfig():
         "autostart": false,
         "samples": 500,
         "refresh": 40,
+        "maxrefresh": 500,
         "delimiter": ";",
+        "format": "text",
+        "binaryformat": "<6f",
+        "syncbytes": "AA55",
+        "crc": true,
+        "blepacketlines": false,
         "autoscaleinterval": 150,
+        "decimation": true,
+        "filterplot": "filtered",
+        "filtercsv": "filtered",
+        "spectrum": true,
+        "fftsize": 1024,
+        "fftoverlap": 0.5,
+        "fftaverages": 8,
+        "loglines": 5000,
+        "lograte": 200,
         "csvpath": "<home>/Documents/data_<date>_<time>.csv",
+        "csvflushinterval": 1.0,
+        "csvbuffersize": 1048576,
+        "samplerate": null,
+        "statsinterval": 10,
+        "statsfile": null,
         "cmdstartwritecsv": null,
         "cmdstopwritecsv": null,
         "cmdconnect": null,
@@ -41,7 +82,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             },
             {
                 "label": "Channel 2",
@@ -49,7 +91,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             },
             {
                 "label": "Channel 3",
@@ -57,7 +100,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             },
             {
                 "label": "Channel 4",
@@ -65,7 +109,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             },
             {
                 "label": "Channel 5",
@@ -73,7 +118,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             },
             {
                 "label": "Channel 6",
@@ -81,7 +127,8 @@ def getdefaultconfig():
                 "offset": 0,
                 "scale_factor": 1,
                 "min": null,
-                "max": null
+                "max": null,
+                "filters": []
             }
         ]
     }
@@ -0,0 +1,81 @@
+# Project: Serial Data Plotter
+# derived channels for SerialDataPlotter.py, computed by the acquisition thread after parsing
+#
+# a channel entry with an "expression" is not read from the device but computed from other
+# channels, e.g. "ch1 * ch2" (power), "sqrt(ch1**2 + ch2**2 + ch3**2)" (magnitude) or "ch2 - ch1".
+# chN is the N-th entry of "channels" (after its offset and scale_factor), a derived channel can
+# use the input channels and the derived channels before it. the device sends the input channels
+# only, in their order. allowed: numbers, pi, e, + - * / // % **, and the functions in FUNCTIONS.
+# every expression is checked and compiled once, then evaluated with numpy on the whole batch,
+# so a derived channel costs a few array operations per batch and nothing per sample.
+# derived channels are plotted, filtered and recorded like the others.
+
+import ast
+import numpy as np
+
+FUNCTIONS = {
+    'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'asin': np.arcsin, 'acos': np.arccos,
+    'atan': np.arctan, 'atan2': np.arctan2, 'hypot': np.hypot, 'sign': np.sign,
+    'min': np.minimum, 'max': np.maximum, 'floor': np.floor, 'round': np.round,
+}
+CONSTANTS = {'pi': np.pi, 'e': np.e}
+OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.UAdd, ast.USub)
+
+
+def inputchannels(config):
+    # indices of the channels sent by the device
+    return [i for i, channel in enumerate(config['channels'][:config['plots']]) if not channel.get('expression')]
+
+
+def compileexpression(expression, known):
+    # expression -> code object, ValueError if it uses anything but arithmetic, FUNCTIONS and <known> names
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError as e:
+        raise ValueError(F'invalid expression "{expression}": {e.msg}') from None
+    called = {id(node.func) for node in ast.walk(tree) if isinstance(node, ast.Call)}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in known and node.id not in CONSTANTS and not (node.id in FUNCTIONS and id(node) in called):
+                raise ValueError(F'unknown name "{node.id}" in expression "{expression}"')
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in FUNCTIONS or node.keywords:
+                raise ValueError(F'only calls of {", ".join(FUNCTIONS)} allowed in expression "{expression}"')
+        elif isinstance(node, ast.Constant):
+            if not isinstance(node.value, (int, float)) or isinstance(node.value, bool):
+                raise ValueError(F'only numbers allowed in expression "{expression}"')
+        elif not isinstance(node, (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Load) + OPERATORS):
+            raise ValueError(F'{type(node).__name__} not allowed in expression "{expression}"')
+    return compile(tree, F'<{expression}>', 'eval')
+
+
+class DerivedChannels:
+    def __init__(self, config):
+        channels = config['channels'][:config['plots']]
+        self.channels = len(channels)
+        self.inputs = inputchannels(config)
+        self.active = len(self.inputs) < self.channels
+        self.expressions = []   # (channel index, code) in channel order
+        known = {F'ch{i + 1}' for i in self.inputs}
+        for i, channel in enumerate(channels):
+            if channel.get('expression'):
+                try:
+                    self.expressions.append((i, compileexpression(channel['expression'], known)))
+                except ValueError as e:
+                    raise ValueError(F'channel "{channel["label"]}": {e}') from None
+                known.add(F'ch{i + 1}')
+
+    def process(self, values):
+        # input rows x inputs -> rows x channels
+        if not self.active:
+            return values
+        result = np.empty((len(values), self.channels))
+        result[:, self.inputs] = values
+        names = dict(FUNCTIONS, **CONSTANTS)
+        names.update((F'ch{i + 1}', result[:, i]) for i in self.inputs)
+        with np.errstate(all='ignore'): # e.g. sqrt of a negative or / 0 gives nan or inf, as in numpy
+            for i, code in self.expressions:
+                result[:, i] = eval(code, {'__builtins__': {}}, names)
+                names[F'ch{i + 1}'] = result[:, i]
+        return result
@@ -0,0 +1,215 @@
+# Project: Serial Data Plotter
+# per-channel filters for SerialDataPlotter.py, run by the acquisition thread after parsing
+#
+# every channel entry of the config can have a "filters" list, applied in order, e.g.
+#   "filters": [{"type": "median", "length": 5}, {"type": "movingaverage", "length": 10},
+#               {"type": "decimate", "factor": 10}]
+# - "movingaverage": mean of the last "length" samples
+# - "fir":           FIR filter with the coefficients "taps"
+# - "biquad":        IIR second order section, "b": [b0, b1, b2], "a": [a0, a1, a2] (several
+#                    entries for higher orders), vectorized with scipy if installed
+# - "median":        median of the last "length" samples, removes spikes
+# - "decimate":      keeps every "factor"-th sample, only as last filter of a channel
+#                    (no anti-aliasing, put a movingaverage or fir in front)
+# every filter works on a whole batch at once and keeps its state (the last inputs, the IIR
+# state, the decimation phase) between batches, so the result does not depend on how the
+# stream was cut into batches. the state starts as if the first sample had always been there.
+#
+# the rows stay aligned across channels: a row is kept if at least one channel has a new
+# (decimated) value in it, the other decimated channels repeat their last value.
+# "filterplot" and "filtercsv" select what is plotted and recorded: "filtered", "raw" or
+# "both" (the filtered channels followed by the raw ones, all rows, "<label> (raw)" in the CSV).
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+try:
+    from scipy.signal import lfilter
+except ImportError: # plain Python loop instead, fine for a few kHz
+    lfilter = None
+
+
+class MovingAverage:
+    def __init__(self, length):
+        self.length = int(length)
+        self.reset()
+
+    def reset(self):
+        self.history = None     # last length-1 inputs
+
+    def process(self, x):
+        if self.history is None:
+            self.history = np.full(self.length - 1, x[0])
+        extended = np.concatenate((self.history, x))
+        sums = np.cumsum(np.concatenate(([0.0], extended)))
+        self.history = extended[len(extended) - (self.length - 1):]
+        return (sums[self.length:] - sums[:-self.length]) / self.length
+
+
+class FIR:
+    def __init__(self, taps):
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        self.history = None     # last len(taps)-1 inputs
+
+    def process(self, x):
+        if self.history is None:
+            self.history = np.full(len(self.taps) - 1, x[0])
+        extended = np.concatenate((self.history, x))
+        self.history = extended[len(extended) - (len(self.taps) - 1):]
+        return np.convolve(extended, self.taps, mode='valid')
+
+
+class Biquad:
+    # transposed direct form II, as scipy.signal.lfilter
+    def __init__(self, b, a):
+        if len(b) != 3 or len(a) != 3 or not a[0]:
+            raise ValueError(F'biquad needs 3 coefficients "b" and "a" with a[0] != 0, got b={b}, a={a}')
+        self.b = np.asarray(b, dtype=np.float64) / a[0]
+        self.a = np.asarray(a, dtype=np.float64) / a[0]
+        self.reset()
+
+    def reset(self):
+        self.state = None       # z1, z2
+
+    def process(self, x):
+        b0, b1, b2 = self.b
+        _, a1, a2 = self.a
+        if self.state is None: # steady state for a constant input x[0]
+            y = x[0] * self.b.sum() / self.a.sum() if self.a.sum() else 0.0
+            z2 = b2 * x[0] - a2 * y
+            self.state = np.array([b1 * x[0] - a1 * y + z2, z2])
+        if lfilter is not None:
+            y, self.state = lfilter(self.b, self.a, x, zi=self.state)
+            return y
+        z1, z2 = self.state
+        y = np.empty(len(x))
+        for i, xi in enumerate(x.tolist()):
+            yi = b0 * xi + z1
+            z1 = b1 * xi - a1 * yi + z2
+            z2 = b2 * xi - a2 * yi
+            y[i] = yi
+        self.state = np.array([z1, z2])
+        return y
+
+
+class Median:
+    def __init__(self, length):
+        self.length = int(length)
+        self.reset()
+
+    def reset(self):
+        self.history = None     # last length-1 inputs
+
+    def process(self, x):
+        if self.history is None:
+            self.history = np.full(self.length - 1, x[0])
+        extended = np.concatenate((self.history, x))
+        self.history = extended[len(extended) - (self.length - 1):]
+        return np.median(sliding_window_view(extended, self.length), axis=1)
+
+
+class Decimate:
+    def __init__(self, factor):
+        self.factor = int(factor)
+        self.reset()
+
+    def reset(self):
+        self.phase = 0          # samples since the last kept one
+        self.last = None        # last kept value, repeated in the rows of other channels
+
+    def process(self, x):
+        # -> (x with the dropped samples replaced by the last kept one, mask of the kept samples)
+        keep = (np.arange(self.phase, self.phase + len(x)) % self.factor) == 0
+        self.phase = (self.phase + len(x)) % self.factor
+        index = np.maximum.accumulate(np.where(keep, np.arange(len(x)), -1))
+        y = x[np.maximum(index, 0)]
+        y[index < 0] = self.last
+        if len(x):
+            self.last = y[-1]
+        return y, keep
+
+
+FILTERS = {
+    'movingaverage': lambda spec: MovingAverage(spec['length']),
+    'fir': lambda spec: FIR(spec['taps']),
+    'biquad': lambda spec: Biquad(spec['b'], spec['a']),
+    'median': lambda spec: Median(spec['length']),
+    'decimate': lambda spec: Decimate(spec['factor']),
+}
+
+
+def getfilter(spec):
+    if spec.get('type') not in FILTERS:
+        raise ValueError(F'unknown filter type "{spec.get("type")}", known: {", ".join(FILTERS)}')
+    return FILTERS[spec['type']](spec)
+
+
+def hasfilters(config):
+    return any(channel.get('filters') for channel in config['channels'][:config['plots']])
+
+
+def outputlabels(config, output):
+    # column labels for "filterplot"/"filtercsv" = <output>
+    labels = [config['channels'][i]['label'] for i in range(config['plots'])]
+    if output == 'both' and hasfilters(config):
+        return labels + [F'{label} (raw)' for label in labels]
+    return labels
+
+
+class FilterBank:
+    def __init__(self, config):
+        self.active = hasfilters(config)
+        self.plotoutput = config['filterplot']
+        self.csvoutput = config['filtercsv']
+        for output in (self.plotoutput, self.csvoutput):
+            if output not in ('filtered', 'raw', 'both'):
+                raise ValueError(F'"filterplot" and "filtercsv" must be "filtered", "raw" or "both", not "{output}"')
+        self.chains = []        # filters of every channel
+        self.decimators = []    # Decimate of every channel or None
+        for channel in config['channels'][:config['plots']]:
+            chain = [getfilter(spec) for spec in channel.get('filters') or []]
+            if any(isinstance(f, Decimate) for f in chain[:-1]):
+                raise ValueError(F'"decimate" must be the last filter of channel "{channel["label"]}"')
+            decimator = chain.pop() if chain and isinstance(chain[-1], Decimate) else None
+            self.chains.append(chain)
+            self.decimators.append(decimator)
+
+    def reset(self):
+        # start again as if nothing had been received, e.g. after a reconnect
+        for chain, decimator in zip(self.chains, self.decimators):
+            for f in chain + ([decimator] if decimator is not None else []):
+                f.reset()
+
+    def filter(self, values):
+        # raw rows x channels -> (filtered rows x channels, all rows, mask of the rows to keep)
+        filtered = np.empty_like(values)
+        keep = np.zeros(len(values), dtype=bool)
+        for i, (chain, decimator) in enumerate(zip(self.chains, self.decimators)):
+            x = values[:, i]
+            for f in chain:
+                x = f.process(x)
+            if decimator is not None:
+                x, kept = decimator.process(x)
+                keep |= kept
+            else:
+                keep[:] = True
+            filtered[:, i] = x
+        return filtered, keep
+
+    def process(self, values):
+        # raw rows x channels -> (rows to plot, rows to record)
+        if not self.active or not len(values):
+            return values, values
+        filtered, keep = self.filter(values)
+        return self.select(values, filtered, keep, self.plotoutput), self.select(values, filtered, keep, self.csvoutput)
+
+    @staticmethod
+    def select(raw, filtered, keep, output):
+        if output == 'raw':
+            return raw
+        if output == 'both': # all rows, the raw ones can't be decimated
+            return np.hstack((filtered, raw))
+        return filtered[keep]
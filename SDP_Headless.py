@@ -0,0 +1,201 @@
+# Project: Serial Data Plotter
+# headless recording with the config of SerialDataPlotter.py, for unattended PCs:
+# connects (serial, BLE, TCP, UDP or pipe, see SDP_Transport.py), sends "cmdconnect" and "cmdstartwritecsv", records to "csvpath"
+# until --duration is over or Ctrl+C, then sends "cmdstopwritecsv" and closes the file.
+#
+# no widgets, no pyqtgraph and no plot buffer: only the acquisition thread and the CSV
+# recorder run, so the rate is limited by parsing and disk only.
+# the terminal log (malformed lines, errors) and the stats go to stdout, and to "statsfile"
+# every "statsinterval" seconds if set (see SDP_Latency.py).
+#
+# e.g.: python SDP_Headless.py --config myconfig.json --duration 3600
+
+import SDP_Config as SDP
+import SDP_BLE as BLE
+from SDP_Acquisition import AcquisitionWorker
+from SDP_Recorder import CSVRecorder
+from SDP_Filter import outputlabels
+from SDP_Latency import dumpstats
+
+import asyncio
+import argparse
+import functools
+import sys
+import time
+from PyQt5 import QtCore
+
+
+class HeadlessRecorder:
+    def __init__(self, config, buffer=None, output=print):
+        self.config = config
+        self.output = output    # for all messages, print or e.g. a queue to another process
+        self.ble = BLE.BLE()
+        self.useBLE = False
+        self.connected = False
+        self.recorder = None
+        self.acquisition = AcquisitionWorker(config, buffer) # usually no buffer: nothing is plotted
+        self.statsfile = SDP.expandpath(config['statsfile']) if config['statsfile'] else None
+
+    async def connect(self, sendconnect=True):
+        # sendconnect False: "cmdconnect" is sent by someone else (the GUI in SDP_Remote.py)
+        address = self.config['com']
+        if "Address" in address: # BLE
+            address = address.replace("Address ", "")
+            self.output(F"[-PC-] Connecting to {address}")
+            self.acquisition.start_ble()
+            self.connected = await self.ble.connect_to_device(address, self.receive)
+            self.useBLE = True
+            if not self.connected:
+                self.acquisition.stop()
+        else: # Serial, TCP, UDP or pipe, see SDP_Transport.py
+            self.connected = self.acquisition.open_transport(address)
+        if not self.connected:
+            self.print_log()
+            self.output(F"[-PC-]  Failed to connect to {self.config['com']}")
+            return False
+        if self.config['cmdconnect'] is not None and sendconnect:
+            await self.sendCommand(self.config['cmdconnect'])
+        return True
+
+    def receive(self, sender, data):
+        self.acquisition.feed(data)
+
+    async def sendCommand(self, command):
+        command = SDP.expandcommand(command)
+        self.output(F"[-PC-] Sending command: {command}")
+        await self.send(command.encode() if self.useBLE else command.encode() + b'\r\n') # as Widget.sendCommand
+
+    async def send(self, data):
+        if self.useBLE:
+            await self.ble.send_data(data)
+        else:
+            self.acquisition.write(data)
+
+    async def start_csv(self):
+        # opens the CSV file unless open_csv() already did, then sends "cmdstartwritecsv"
+        if self.recorder is None and not self.open_csv(SDP.expandpath(self.config['csvpath'])):
+            return False
+        if self.config['cmdstartwritecsv'] is not None:
+            await self.sendCommand(self.config['cmdstartwritecsv'])
+        return True
+
+    def open_csv(self, filename):
+        try:
+            self.recorder = CSVRecorder(filename, outputlabels(self.config, self.config['filtercsv']),
+                                        flushinterval=self.config['csvflushinterval'],
+                                        buffersize=self.config['csvbuffersize'])
+        except OSError as e:
+            self.output(F'[-PC-] Error: could not open {filename}: {e}')
+            return False
+        self.acquisition.set_recorder(self.recorder)
+        self.output(F'[-PC-] Writing data to {filename}')
+        return True
+
+    async def stop_csv(self):
+        if self.recorder is not None:
+            if self.config['cmdstopwritecsv'] is not None:
+                await self.sendCommand(self.config['cmdstopwritecsv'])
+                await asyncio.sleep(0.1) # give the acquisition thread time to send it
+            self.close_csv()
+
+    def close_csv(self):
+        if self.recorder is not None:
+            self.acquisition.set_recorder(None)
+            self.recorder.close()
+            self.output(F'[-PC-] Stopped writing to {self.recorder.filename}, {self.recorder.bytes_written} bytes written')
+            self.recorder = None
+
+    async def disconnect(self):
+        if self.useBLE and self.connected:
+            await self.ble.disconnect()
+        self.acquisition.stop()
+        self.connected = False
+
+    async def stop(self):
+        await self.stop_csv()
+        await self.disconnect()
+        self.print_log()
+        self.print_stats()
+
+    def print_log(self):
+        for text in self.acquisition.get_log():
+            self.output(text)
+
+    def print_stats(self, rate=None):
+        stats = self.acquisition.stats()
+        text = (F"[-PC-] Received {stats['lines']} lines: {stats['samples']} samples parsed, "
+                F"{stats['malformed']} malformed, {stats['dropped']} BLE packets dropped")
+        if rate is not None:
+            text += F", {rate:.0f} samples/s"
+        if self.recorder is not None:
+            text += F", {self.recorder.queue_depth()} batches queued for the CSV file"
+        self.output(text)
+        self.output(self.acquisition.latency.text())
+
+    def dump_stats(self):
+        try:
+            dumpstats(self.statsfile, {'acquisition': self.acquisition.stats(),
+                                       'csvqueue': self.recorder.queue_depth() if self.recorder is not None else None,
+                                       'latency': self.acquisition.latency.summary()})
+        except OSError as e:
+            self.output(F"[-PC-] Error writing stats to {self.statsfile}: {e}")
+            self.statsfile = None
+
+    async def run(self, duration=None, statsinterval=10.0):
+        # the CSV file first: the samples are stored as soon as connect() started the transport
+        if not self.open_csv(SDP.expandpath(self.config['csvpath'])):
+            return 1
+        if not await self.connect():
+            self.close_csv()
+            return 1
+        try:
+            if not await self.start_csv():
+                return 1
+            start = laststats = lastdump = time.monotonic()
+            samples = 0
+            while self.acquisition.isRunning() and (duration is None or time.monotonic() - start < duration):
+                await asyncio.sleep(0.2)
+                self.print_log()
+                if self.recorder.error is not None:
+                    self.output(F'[-PC-] Error writing to {self.recorder.filename}: {self.recorder.error}')
+                    return 1
+                if statsinterval and time.monotonic() - laststats >= statsinterval:
+                    now = time.monotonic()
+                    rate = (self.acquisition.samples - samples) / (now - laststats)
+                    samples = self.acquisition.samples
+                    laststats = now
+                    self.print_stats(rate)
+                if self.statsfile and self.config['statsinterval'] and \
+                        time.monotonic() - lastdump >= self.config['statsinterval']:
+                    lastdump = time.monotonic()
+                    self.dump_stats()
+        finally:
+            await self.stop()
+        return 0
+
+
+if __name__ == '__main__':
+    # command line arguments (overwrite options from config file)
+    parser = argparse.ArgumentParser(description='Record serial or BLE data to CSV without GUI')
+    parser.add_argument("--com", help="COM Port, \"Address <device address>\" for BLE, tcp://, tcpserver://, udp:// or pipe://",
+                        default=None)
+    parser.add_argument("--plots", type=int, help="Number of channels", default=None)
+    parser.add_argument("--config", help="config file", default=None)
+    parser.add_argument("--csvpath", help="CSV file, <home>, <date> and <time> are replaced", default=None)
+    parser.add_argument("--duration", type=float, help="seconds to record, default: until Ctrl+C", default=None)
+    parser.add_argument("--stats", type=float, help="seconds between stats outputs, 0: none", default=10.0)
+
+    args = parser.parse_args()
+    config = SDP.loadconfig(args.config)
+    if args.com is not None:
+        config['com'] = args.com
+    if args.plots is not None:
+        config['plots'] = args.plots
+    if args.csvpath is not None:
+        config['csvpath'] = args.csvpath
+
+    app = QtCore.QCoreApplication(sys.argv) # for the QThread and QSerialPort, no Qt event loop needed
+    try:
+        sys.exit(asyncio.run(HeadlessRecorder(config, output=functools.partial(print, flush=True)).run(args.duration, args.stats)))
+    except KeyboardInterrupt: # the recording was stopped and closed in HeadlessRecorder.run
+        pass
@@ -0,0 +1,122 @@
+# Project: Serial Data Plotter
+# latency statistics for SerialDataPlotter.py and SDP_Headless.py
+#
+# every read from the port (every BLE notification) gets a host timestamp (time.perf_counter)
+# on arrival, all samples completed by it share that timestamp. two stages are measured:
+# - arrival -> parse:  until the samples are parsed and stored in the buffer (acquisition thread),
+#                      includes waiting in the BLE receive queue
+# - parse -> render:   until update_plot handed them to the curves (GUI thread), includes
+#                      waiting for the timer, so it shows if "refresh" is the bottleneck
+# arrival -> render is the sum of both. the repaint after update_plot is not included,
+# see RenderScheduler.cost for it.
+# histograms are counted per sample, in logarithmic bins from 10 us to 10 s.
+# with "statsfile" set, the stats are appended every "statsinterval" seconds as one JSON line.
+
+from collections import deque
+import datetime
+import json
+import time
+import numpy as np
+
+
+def dumpstats(filename, stats):
+    # appends stats (dict) with a timestamp as one JSON line
+    with open(filename, 'a') as f:
+        f.write(json.dumps({'time': datetime.datetime.now().isoformat(timespec='milliseconds'), **stats}) + '\n')
+
+
+class LatencyHistogram:
+    edges = np.logspace(-2, 4, 121) # ms, 20 bins per decade
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64) # + below and above the range
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency, samples=1):
+        # latency in ms, for <samples> samples
+        self.counts[np.searchsorted(self.edges, latency)] += samples
+        self.count += samples
+        self.total += latency * samples
+        self.max = max(self.max, latency)
+
+    def add_many(self, latencies, samples):
+        # arrays of latencies in ms and samples
+        np.add.at(self.counts, np.searchsorted(self.edges, latencies), samples)
+        self.count += int(np.sum(samples))
+        self.total += float(np.dot(latencies, samples))
+        self.max = max(self.max, float(np.max(latencies)))
+
+    def percentile(self, q):
+        # upper edge of the bin holding the q-th percentile (at most the maximum)
+        if not self.count:
+            return None
+        i = int(np.searchsorted(np.cumsum(self.counts), self.count * q / 100))
+        return min(float(self.edges[min(i, len(self.edges) - 1)]), self.max)
+
+    def summary(self):
+        if not self.count:
+            return {'samples': 0}
+        return {'samples': self.count, 'mean': round(self.total / self.count, 3),
+                'p50': round(self.percentile(50), 3), 'p95': round(self.percentile(95), 3),
+                'p99': round(self.percentile(99), 3), 'max': round(self.max, 3)}
+
+
+class LatencyStats:
+    def __init__(self, render=True):
+        self.render = render            # False if nothing is rendered (SDP_Headless.py)
+        self.arrival_parse = LatencyHistogram()
+        self.parse_render = LatencyHistogram()
+        self.arrival_render = LatencyHistogram()
+        self.pending = deque()          # (arrival, stored, samples) of the batches not rendered yet
+
+    def stored(self, arrival, samples):
+        # acquisition thread, with the buffer lock held, right after the batch was stored
+        now = time.perf_counter()
+        self.arrival_parse.add((now - arrival) * 1000, samples)
+        if self.render:
+            self.pending.append((arrival, now, samples))
+
+    def take(self):
+        # GUI thread, with the buffer lock held: the batches in the snapshot that is drawn next
+        batches = []
+        for _ in range(len(self.pending)):
+            batches.append(self.pending.popleft())
+        return batches
+
+    def rendered(self, batches):
+        # GUI thread, after the batches were handed to the curves
+        if not batches:
+            return
+        now = time.perf_counter()
+        arrival, stored, samples = np.array(batches).T
+        self.parse_render.add_many((now - stored) * 1000, samples.astype(np.int64))
+        self.arrival_render.add_many((now - arrival) * 1000, samples.astype(np.int64))
+
+    def reset(self):
+        self.arrival_parse.reset()
+        self.parse_render.reset()
+        self.arrival_render.reset()
+
+    def summary(self):
+        summary = {'arrival_parse': self.arrival_parse.summary()}
+        if self.render:
+            summary['parse_render'] = self.parse_render.summary()
+            summary['arrival_render'] = self.arrival_render.summary()
+        return summary
+
+    def text(self):
+        # one line per stage, for the stats panel and the console
+        lines = []
+        for stage, summary in self.summary().items():
+            if summary['samples']:
+                lines.append(F"{stage.replace('_', ' -> '):18} mean {summary['mean']:8.2f} ms, p50 {summary['p50']:8.2f}, "
+                             F"p95 {summary['p95']:8.2f}, p99 {summary['p99']:8.2f}, max {summary['max']:8.2f} ms "
+                             F"({summary['samples']} samples)")
+            else:
+                lines.append(F"{stage.replace('_', ' -> '):18} no samples")
+        return '\n'.join(lines)
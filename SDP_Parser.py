@@ -0,0 +1,209 @@
+# Project: Serial Data Plotter
+# parsers for the incoming data of SerialDataPlotter.py
+#
+# both work on batches: everything received since the last call is split into complete
+# records, all records are converted to a 2d float array (records x channels) in one go,
+# offset and scale_factor of the channels are applied as vectors.
+# only the channels sent by the device are parsed, the derived ones follow (SDP_Derived.py).
+#
+# "format": "text"   - LineParser, delimiter separated ASCII lines (default)
+# "format": "binary" - BinaryParser, fixed layout records:
+#                      <syncbytes> <payload as in struct format "binaryformat"> [<crc>]
+#                      crc: CRC-16/CCITT (init 0xFFFF, as binascii.crc_hqx) of the payload,
+#                      2 bytes in the byte order of binaryformat. the layout is the one of
+#                      struct, so without "<", ">", "!" or "=" native sizes and alignment
+
+import struct
+import sys
+import numpy as np
+
+from SDP_Derived import inputchannels
+
+
+def crctable():
+    # CRC-16/CCITT (polynomial 0x1021) of every byte value, for crc16()
+    table = np.arange(256, dtype=np.uint16) << 8
+    for _ in range(8):
+        table = np.where(table & 0x8000, (table << 1) ^ 0x1021, table << 1).astype(np.uint16)
+    return table
+
+
+CRCTABLE = crctable()
+
+
+def crc16(rows, crc=0xFFFF):
+    # CRC-16/CCITT of every row (rows x bytes, uint8), as binascii.crc_hqx(row, crc). table driven,
+    # one step per byte column for all rows at once
+    crcs = np.full(len(rows), crc, dtype=np.uint16)
+    index = np.empty(len(rows), dtype=np.uint16)
+    for column in np.ascontiguousarray(rows.T):
+        np.right_shift(crcs, 8, out=index)
+        index ^= column
+        crcs <<= 8
+        crcs ^= CRCTABLE.take(index)
+    return crcs
+
+
+def getparser(config):
+    if config['format'] == 'binary':
+        return BinaryParser(config)
+    return LineParser(config)
+
+
+class LineParser:
+    def __init__(self, config):
+        self.delimiter = config['delimiter']
+        channels = [config['channels'][i] for i in inputchannels(config)]
+        self.columns = len(channels)
+        self.offset = np.array([channel['offset'] for channel in channels], dtype=np.float64)
+        self.scale_factor = np.array([channel['scale_factor'] for channel in channels], dtype=np.float64)
+        self.pending = b''  # incomplete line, waiting for the rest of it
+        self.skipped = 0    # bytes that could not be assigned to a record, not reported yet
+        self.packetlines = config['blepacketlines']
+
+    def split(self, data):
+        # bytes -> list of complete lines, the incomplete tail is kept for the next call
+        data = self.pending + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.pending = data
+            return []
+        self.pending = data[end+1:]
+        return data[:end].decode('utf-8', errors='replace').splitlines()
+
+    def packet(self, data):
+        # one BLE notification: lines can be split across notifications (MTU) or several lines can be
+        # in one, so they are reassembled like the serial stream. with "blepacketlines" every notification
+        # ends a line, for devices sending one line per notification without line end
+        if self.packetlines and not data.endswith(b'\n'):
+            data += b'\n'
+        return self.split(data)
+
+    def rawtext(self, lines):
+        # for "Show Raw Data"
+        return '\n'.join(lines)
+
+    def parse(self, lines):
+        # lines -> (values, malformed lines)
+        # values has one row per valid line, surplus columns of a line are ignored like before
+        fields = [line.split(self.delimiter)[:self.columns] for line in lines]
+        try:
+            values = np.array(fields, dtype=np.float64).reshape(len(fields), self.columns)
+            malformed = []
+        except ValueError: # at least one line is not (enough) data: sort out line by line
+            values, malformed = self.parse_slow(lines, fields)
+        return (values - self.offset) * self.scale_factor, malformed
+
+    def parse_slow(self, lines, fields):
+        rows = []
+        malformed = []
+        for line, row in zip(lines, fields):
+            try:
+                if len(row) != self.columns:
+                    raise ValueError
+                rows.append(np.array(row, dtype=np.float64))
+            except ValueError:
+                malformed.append(line)
+        if rows:
+            return np.vstack(rows), malformed
+        return np.empty((0, self.columns)), malformed
+
+
+class BinaryParser(LineParser):
+    # struct format characters -> numpy kinds, the size is the one of struct ("l" is 8 bytes natively on Linux)
+    kinds = {'b': 'i', 'B': 'u', 'h': 'i', 'H': 'u', 'i': 'i', 'I': 'u', 'l': 'i', 'L': 'u',
+             'q': 'i', 'Q': 'u', 'n': 'i', 'N': 'u', 'e': 'f', 'f': 'f', 'd': 'f'}
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.sync = bytes.fromhex(config['syncbytes'])
+        self.syncarray = np.frombuffer(self.sync, dtype=np.uint8)
+        self.crc = config['crc']
+        self.dtype, self.fields, order = self.getdtype(config['binaryformat'])
+        if len(self.fields) < self.columns:
+            raise ValueError(F'binaryformat "{config["binaryformat"]}" holds less than {self.columns} values')
+        self.crcdtype = np.dtype(order + 'u2')
+        self.framesize = len(self.sync) + self.dtype.itemsize + (2 if self.crc else 0)
+
+    def getdtype(self, format):
+        # struct format (e.g. "<6f" or ">hhhI") -> numpy record type, names of the value fields, byte order.
+        # every field is at the offset struct gives it, so native alignment ("@" or no prefix) works too
+        prefix = format[0] if format[:1] in ('<', '>', '!', '=', '@') else '@'
+        order = {'<': '<', '>': '>', '!': '>'}.get(prefix, '<' if sys.byteorder == 'little' else '>')
+        chars = []
+        count = ''
+        for char in format[1:] if format[:1] == prefix else format:
+            if char.isdigit():
+                count += char
+            elif not char.isspace():
+                chars.extend(char * int(count or 1))
+                count = ''
+        names, formats, offsets = [], [], []
+        try:
+            for i, char in enumerate(chars):
+                if char == 'x':
+                    continue
+                if char not in self.kinds:
+                    raise ValueError(F'binaryformat "{format}": "{char}" is not a number format, use one of {"".join(self.kinds)} or x')
+                size = struct.calcsize(prefix + char)
+                names.append(F'f{len(names)}')
+                formats.append(order + self.kinds[char] + str(size))
+                offsets.append(struct.calcsize(prefix + ''.join(chars[:i + 1])) - size)
+            itemsize = struct.calcsize(format)
+        except struct.error as e:
+            raise ValueError(F'binaryformat "{format}": {e}') from None
+        dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+        return dtype, names, order
+
+    def split(self, data):
+        # bytes -> complete frames (frames x framesize, uint8), incomplete tail kept for the next call
+        data = self.pending + data
+        array = np.frombuffer(data, dtype=np.uint8)
+        frames = []
+        pos = 0
+        while len(data) - pos >= self.framesize:
+            # usual case: a run of aligned frames, all starting with the sync bytes
+            n = (len(data) - pos) // self.framesize
+            block = array[pos:pos + n*self.framesize].reshape(n, self.framesize)
+            aligned = np.all(block[:, :len(self.sync)] == self.syncarray, axis=1)
+            good = n if aligned.all() else int(np.argmin(aligned))
+            if good:
+                frames.append(block[:good])
+                pos += good*self.framesize
+            if good == n:
+                break
+            # lost sync: search the next sync bytes
+            nextsync = data.find(self.sync, pos + 1)
+            if nextsync < 0:
+                nextsync = max(pos, len(data) - len(self.sync) + 1)
+            self.skipped += nextsync - pos
+            pos = nextsync
+        self.pending = data[pos:]
+        if frames:
+            return np.vstack(frames)
+        return np.empty((0, self.framesize), dtype=np.uint8)
+
+    def packet(self, data):
+        return self.split(data)
+
+    def rawtext(self, frames):
+        return '\n'.join(frame.tobytes().hex(' ') for frame in frames)
+
+    def parse(self, frames):
+        malformed = []
+        if self.skipped:
+            malformed.append(F'[-PC-] Skipped {self.skipped} bytes searching for sync bytes')
+            self.skipped = 0
+        payload = frames[:, len(self.sync):len(self.sync) + self.dtype.itemsize]
+        if self.crc and len(frames):
+            received = np.frombuffer(np.ascontiguousarray(frames[:, -2:]).tobytes(), dtype=self.crcdtype)
+            calculated = crc16(payload)
+            valid = received == calculated
+            if not valid.all():
+                malformed.extend(F'[-PC-] CRC error: {frame.tobytes().hex(" ")}' for frame in frames[~valid])
+                payload = payload[valid]
+        records = np.frombuffer(np.ascontiguousarray(payload).tobytes(), dtype=self.dtype)
+        values = np.empty((len(records), self.columns))
+        for i in range(self.columns):
+            values[:, i] = records[self.fields[i]]
+        return (values - self.offset) * self.scale_factor, malformed
@@ -0,0 +1,301 @@
+# Project: Serial Data Plotter
+# CSV recorders for SerialDataPlotter.py and MultipleSDPLauncher.py
+#
+# takes batches of parsed samples (rows x channels), formats each batch in one go and
+# writes it from a background thread into a large file buffer, so disk latency spikes
+# never reach the acquisition or GUI thread. the file is flushed every
+# csvflushinterval seconds, csvbuffersize is the size of the file buffer in bytes.
+# a write error (e.g. disk full) ends the recording: it is kept in "error", later batches are dropped.
+
+import json
+import queue
+import threading
+import time
+import numpy as np
+
+
+def close_after_error(file, batches):
+    # after a write error: closes what can be closed, frees the queued batches
+    try:
+        file.close()
+    except OSError: # the buffered rest can't be written either
+        pass
+    while not batches.empty():
+        batches.get()
+
+
+class CSVRecorder(threading.Thread):
+    def __init__(self, filename, labels, delimiter=';', flushinterval=1.0, buffersize=1048576):
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.flushinterval = flushinterval
+        self.rowformat = delimiter.join(['%s'] * len(labels)) + '\n'
+        self.queue = queue.Queue()  # unbounded: samples are never dropped, see queue_depth()
+        self.bytes_written = 0
+        self.error = None           # OSError that ended the recording
+        self.file = open(filename, 'w', buffering=buffersize) # raises OSError, nothing started yet
+        self.write(delimiter.join(labels) + '\n')
+        self.start()
+
+    def put(self, values):
+        # values: numpy array, one row per sample
+        if self.error is None:
+            self.queue.put(values)
+
+    def queue_depth(self):
+        # batches waiting to be written
+        return self.queue.qsize()
+
+    def close(self):
+        # writes everything still queued, then closes the file
+        self.queue.put(None)
+        self.join()
+
+    def write(self, text):
+        self.file.write(text)
+        self.bytes_written += len(text) # only ASCII is written: characters == bytes
+
+    def run(self):
+        try:
+            self.record()
+        except OSError as e:
+            self.error = e
+            close_after_error(self.file, self.queue)
+
+    def record(self):
+        lastflush = time.monotonic()
+        closing = False
+        while not closing:
+            try:
+                batches = [self.queue.get(timeout=self.flushinterval)]
+            except queue.Empty:
+                batches = []
+            while not self.queue.empty(): # collect everything that arrived meanwhile
+                batches.append(self.queue.get())
+            if batches and batches[-1] is None:
+                closing = True
+                batches.pop()
+            for values in batches:
+                if len(values):
+                    # one % operation formats the whole batch, same number format as str(float)
+                    self.write((self.rowformat * len(values)) % tuple(values.ravel().tolist()))
+            if time.monotonic() - lastflush >= self.flushinterval:
+                self.file.flush()
+                lastflush = time.monotonic()
+        self.file.close()
+
+
+class MergedRecorder(threading.Thread):
+    # one time-ordered CSV file from several sources (MultipleSDPLauncher instances).
+    # every batch is timestamped with the host clock when stored, the samples of a batch are
+    # spread linearly since the previous batch of the same source. a streaming k-way merge writes
+    # all samples older than the newest timestamp of the slowest source, so memory stays bounded
+    # by maxdelay: a source without data for maxdelay seconds does not hold back the others.
+    #
+    # columns: time (s since epoch); source; sample (index within the source); then the channels of
+    # all sources, only those of "source" are filled. <filename>.json holds the sources, their labels
+    # and the clock of every source, fitted to the host clock (offset: host time of sample 0, rate in Hz,
+    # skew_ppm against "samplerate" of its config), so time = offset + sample / rate can be computed
+    # in a single pass over the file. it is updated with every flush, so it survives a crash.
+    def __init__(self, filename, sources, delimiter=';', maxdelay=1.0, flushinterval=1.0, buffersize=1048576):
+        # sources: list of (name, labels, nominal samplerate or None)
+        super().__init__(daemon=True)
+        self.filename = filename
+        self.maxdelay = maxdelay
+        self.flushinterval = flushinterval
+        self.queue = queue.Queue()  # (source, stored time, values), None to close
+        self.bytes_written = 0
+        self.error = None           # OSError that ended the recording, as CSVRecorder
+        self.late = 0               # samples older than what was already written, written anyway
+        self.written = None         # time of the newest sample written
+        self.start_time = time.time()
+        self.started = time.monotonic()
+        self.sources = []
+        width = sum(len(labels) for _, labels, _ in sources)
+        column = 0
+        for index, (name, labels, samplerate) in enumerate(sources):
+            cells = [''] * width
+            cells[column:column + len(labels)] = ['%s'] * len(labels)
+            column += len(labels)
+            self.sources.append({
+                'name': name, 'labels': labels, 'samplerate': samplerate,
+                'rowformat': delimiter.join(['%.6f', str(index), '%d'] + cells) + '\n',
+                'pending': [],      # (times, samples, values) not written yet
+                'last': None,       # time of the newest sample
+                'received': None,   # time.monotonic() of the newest batch
+                'samples': 0,
+                'fit': np.zeros(5), # n, sum x, sum y, sum xx, sum xy of (sample, time - start_time)
+                'open': True,
+            })
+        self.file = open(filename, 'w', buffering=buffersize) # raises OSError, nothing started yet
+        self.write(delimiter.join(['time', 'source', 'sample'] +
+                                  [label for source in self.sources for label in source['labels']]) + '\n')
+        self.start()
+
+    def source(self, index):
+        return MergeSource(self, index)
+
+    def put(self, index, values, stored=None):
+        # any thread: values rows x channels of source <index>, stored: time.perf_counter() of the newest
+        if self.error is not None:
+            return
+        offset = time.time() - time.perf_counter()
+        self.queue.put((index, (time.perf_counter() if stored is None else stored) + offset, values))
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def close_source(self, index):
+        # the last source closed closes the file
+        self.queue.put((index, None, None))
+        self.sources[index]['open'] = False
+        if not any(source['open'] for source in self.sources):
+            self.close()
+
+    def close(self):
+        self.queue.put(None)
+        if self is not threading.current_thread():
+            self.join()
+
+    def write(self, text):
+        self.file.write(text)
+        self.bytes_written += len(text) # only ASCII is written: characters == bytes
+
+    def add(self, index, stored, values):
+        source = self.sources[index]
+        n = len(values)
+        if not n:
+            return
+        last = source['last']
+        if last is None or stored - last > self.maxdelay or stored <= last: # no previous batch to interpolate from
+            times = np.full(n, stored)
+        else:
+            times = last + (stored - last) * np.arange(1, n + 1) / n
+        samples = np.arange(source['samples'], source['samples'] + n)
+        source['pending'].append((times, samples, np.asarray(values, dtype=np.float64)))
+        source['last'] = stored
+        source['received'] = time.monotonic()
+        source['samples'] += n
+        x = samples[-1]
+        y = stored - self.start_time
+        source['fit'] += (1, x, y, x * x, x * y)
+
+    def merge(self, final=False):
+        # writes all pending samples up to the watermark, time-ordered
+        now = time.monotonic()
+        watermark = None
+        if not final:
+            for source in self.sources:
+                if source['received'] is not None and now - source['received'] < self.maxdelay:
+                    mark = source['last']
+                elif source['received'] is None and now - self.started < self.maxdelay:
+                    mark = -np.inf # no data yet, wait for it a little
+                else:
+                    mark = time.time() - self.maxdelay # idle source, don't wait for it
+                watermark = mark if watermark is None else min(watermark, mark)
+        chunks = {}
+        for index, source in enumerate(self.sources):
+            if not source['pending']:
+                continue
+            times = np.concatenate([t for t, _, _ in source['pending']])
+            samples = np.concatenate([s for _, s, _ in source['pending']])
+            values = np.concatenate([v for _, _, v in source['pending']])
+            ready = len(times) if final else int(np.searchsorted(times, watermark, side='right'))
+            source['pending'] = [(times[ready:], samples[ready:], values[ready:])] if ready < len(times) else []
+            if ready:
+                chunks[index] = (times[:ready], samples[:ready], values[:ready])
+        if not chunks:
+            return
+        # k-way merge of the sorted runs of all sources
+        times = np.concatenate([chunk[0] for chunk in chunks.values()])
+        indices = np.concatenate([np.full(len(chunk[0]), index) for index, chunk in chunks.items()])
+        positions = np.concatenate([np.arange(len(chunk[0])) for chunk in chunks.values()])
+        order = np.argsort(times, kind='stable')
+        if self.written is not None:
+            self.late += int(np.sum(times < self.written))
+        self.written = max(self.written or -np.inf, times[order[-1]])
+        indices = indices[order]
+        positions = positions[order]
+        # consecutive samples of the same source are formatted in one go
+        bounds = np.flatnonzero(np.diff(indices)) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(order)]):
+            index = indices[start]
+            chunk_times, chunk_samples, chunk_values = chunks[index]
+            rows = positions[start:stop]
+            block = np.column_stack((chunk_times[rows], chunk_samples[rows], chunk_values[rows]))
+            self.write((self.sources[index]['rowformat'] * len(block)) % tuple(block.ravel().tolist()))
+
+    def clocks(self):
+        # fitted clock of every source: time = offset + sample / rate
+        clocks = []
+        for index, source in enumerate(self.sources):
+            n, sx, sy, sxx, sxy = source['fit']
+            clock = {'source': index, 'name': source['name'], 'labels': source['labels'], 'samples': source['samples']}
+            if n >= 2 and n * sxx - sx * sx > 0:
+                period = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+                if period > 0:
+                    clock['offset'] = self.start_time + (sy - period * sx) / n
+                    clock['rate'] = 1 / period
+                    if source['samplerate']:
+                        clock['skew_ppm'] = (clock['rate'] / source['samplerate'] - 1) * 1e6
+            clocks.append(clock)
+        return clocks
+
+    def write_clocks(self):
+        with open(self.filename + '.json', 'w') as f:
+            json.dump({'file': self.filename, 'start': self.start_time, 'late': self.late,
+                       'columns': 'time;source;sample;<channels of all sources>', 'sources': self.clocks()}, f, indent=4)
+
+    def run(self):
+        try:
+            self.record()
+        except OSError as e:
+            self.error = e
+            close_after_error(self.file, self.queue)
+
+    def record(self):
+        lastflush = time.monotonic()
+        closing = False
+        while not closing:
+            try:
+                items = [self.queue.get(timeout=min(0.1, self.flushinterval))]
+            except queue.Empty:
+                items = []
+            while not self.queue.empty():
+                items.append(self.queue.get())
+            for item in items:
+                if item is None:
+                    closing = True
+                elif item[1] is not None:
+                    self.add(*item)
+            self.merge(final=closing)
+            if closing or time.monotonic() - lastflush >= self.flushinterval:
+                self.file.flush()
+                self.write_clocks()
+                lastflush = time.monotonic()
+        self.file.close()
+
+
+class MergeSource:
+    # CSVRecorder interface for one source of a MergedRecorder, see Widget.start_writing()
+    def __init__(self, merger, index):
+        self.merger = merger
+        self.index = index
+        self.filename = merger.filename
+
+    @property
+    def bytes_written(self):
+        return self.merger.bytes_written
+
+    @property
+    def error(self):
+        return self.merger.error
+
+    def put(self, values, stored=None):
+        self.merger.put(self.index, values, stored)
+
+    def queue_depth(self):
+        return self.merger.queue_depth()
+
+    def close(self):
+        self.merger.close_source(self.index)
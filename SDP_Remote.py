@@ -0,0 +1,361 @@
+# Project: Serial Data Plotter
+# acquisition and CSV recording in a separate process, for MultipleSDPLauncher.py
+#
+# the acquisition process is an SDP_Headless.HeadlessRecorder that stores the samples in a
+# SharedRingBuffer (multiprocessing.shared_memory) instead of a RingBuffer. the GUI process
+# only copies the new samples from there into the RingBuffer of its Widget and renders, so
+# every device gets its own core for reading, parsing and writing CSV.
+# commands (send, raw data, CSV start/stop, stop) go to the process through a queue, log
+# lines and stats come back through another one. the process is started with "spawn" and
+# only imports QtCore, never widgets. the latency stats compare time.perf_counter() of both
+# processes, a system wide monotonic clock on Linux and Windows.
+#
+# RemoteAcquisition has the interface of AcquisitionWorker that Widget uses, RemoteBLE the one
+# of SDP_BLE.BLE and RemoteRecorder the one of CSVRecorder, so Widget runs unchanged with them
+# (see create_acquisition() and create_recorder() of SerialDataPlotter.Widget).
+
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+from SDP_Acquisition import SPSCQueue
+from SDP_Latency import LatencyStats
+from SDP_Filter import outputlabels
+
+SHAREDSAMPLES = 65536   # minimum size of the shared buffer in samples, covers slow GUI frames
+STATSINTERVAL = 0.25    # seconds between stats of the acquisition process
+
+
+class SharedRingBuffer:
+    # samples x channels in shared memory, one writing process, one reading process.
+    # header: samples written in total, arrival and stored time (time.perf_counter) of the newest batch.
+    # the writer stores the samples first and then advances "written", the reader copies
+    # everything up to "written" and checks afterwards that the writer did not overwrite it meanwhile.
+    HEADER = 3
+
+    def __init__(self, channels, samples, name=None):
+        self.channels = channels
+        self.samples = samples
+        size = 8 * (self.HEADER + channels * samples)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.header = np.ndarray((self.HEADER,), dtype=np.float64, buffer=self.shm.buf)
+        self.data = np.ndarray((samples, channels), dtype=np.float64, buffer=self.shm.buf, offset=8 * self.HEADER)
+        if name is None:
+            self.header[:] = 0
+        self.written = int(self.header[0])  # writer: samples written, reader: samples read
+        self.lock = threading.Lock()         # for AcquisitionWorker, as RingBuffer.lock
+
+    def write(self, values):
+        # writer process: values rows x channels
+        n = len(values)
+        if n > self.samples:
+            values = values[-self.samples:]
+            self.written += n - self.samples
+            n = self.samples
+        start = self.written % self.samples
+        first = min(n, self.samples - start)
+        self.data[start:start + first] = values[:first]
+        self.data[:n - first] = values[first:]
+        self.written += n
+        self.header[0] = self.written
+
+    def stored(self, arrival, stored):
+        self.header[1] = arrival
+        self.header[2] = stored
+
+    def read(self):
+        # reader process: (new samples rows x channels, lost samples, arrival, stored)
+        written = int(self.header[0])
+        arrival, stored = self.header[1], self.header[2]
+        start = max(self.written, written - self.samples)
+        lost = start - self.written
+        a = start % self.samples
+        b = a + (written - start)
+        if b <= self.samples:
+            values = self.data[a:b].copy()
+        else:
+            values = np.concatenate((self.data[a:], self.data[:b - self.samples]))
+        overwritten = int(self.header[0]) - self.samples - start # written meanwhile over the oldest copied
+        if overwritten > 0:
+            values = values[overwritten:]
+            lost += overwritten
+        self.written = written
+        return values, lost, arrival, stored
+
+    def close(self):
+        self.header = self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class SharedLatency(LatencyStats):
+    # latency stats of the acquisition process, also publishes the times of the newest batch
+    def __init__(self, shared):
+        super().__init__(render=False)
+        self.shared = shared
+
+    def stored(self, arrival, samples):
+        super().stored(arrival, samples)
+        self.shared.stored(arrival, time.perf_counter())
+
+
+def acquisition_process(config, shmname, capacity, commands, events):
+    # main of the acquisition process
+    from PyQt5 import QtCore
+    from SDP_Headless import HeadlessRecorder
+    app = QtCore.QCoreApplication([])
+    shared = SharedRingBuffer(len(outputlabels(config, config['filterplot'])), capacity, name=shmname)
+    recorder = HeadlessRecorder(config, shared, output=lambda text: events.put(('log', text)))
+    recorder.acquisition.latency = SharedLatency(shared)
+    try:
+        asyncio.run(serve(recorder, commands, events))
+    finally:
+        shared.close()
+
+
+async def serve(recorder, commands, events):
+    connected = await recorder.connect(sendconnect=False) # Widget.on_toggled sends "cmdconnect"
+    events.put(('connected', connected))
+    laststats = 0.0
+    parent = multiprocessing.parent_process()
+    # ends with the acquisition thread too (connection lost), RemoteAcquisition.isRunning() tells the GUI
+    while connected and parent.is_alive() and recorder.acquisition.isRunning():
+        try:
+            kind, argument = commands.get_nowait()
+        except queue.Empty:
+            recorder.print_log()
+            if time.monotonic() - laststats >= STATSINTERVAL:
+                laststats = time.monotonic()
+                events.put(('stats', stats(recorder)))
+            await asyncio.sleep(0.01)
+            continue
+        if kind == 'stop':
+            break
+        elif kind == 'write':
+            await recorder.send(argument)
+        elif kind == 'raw':
+            recorder.acquisition.showraw = argument
+        elif kind == 'csv':
+            events.put(('csv', recorder.open_csv(argument)))
+        elif kind == 'csvstop':
+            csv = recorder.recorder
+            recorder.close_csv()
+            events.put(('csvstop', csv.bytes_written if csv is not None else 0))
+    recorder.close_csv()
+    if connected:
+        await recorder.disconnect()
+    recorder.print_log()
+    events.put(('stats', stats(recorder)))
+    events.put(('stopped', None))
+
+
+def stats(recorder):
+    return {'acquisition': recorder.acquisition.stats(),
+            'csvbytes': recorder.recorder.bytes_written if recorder.recorder is not None else 0,
+            'csvqueue': recorder.recorder.queue_depth() if recorder.recorder is not None else 0,
+            'csverror': str(recorder.recorder.error) if recorder.recorder is not None and recorder.recorder.error else None}
+
+
+class RemoteAcquisition:
+    # GUI side of an acquisition process, used like AcquisitionWorker by Widget
+    def __init__(self, config, buffer):
+        self.config = config
+        self.buffer = buffer    # RingBuffer of the Widget, filled by poll()
+        self.lock = buffer.lock
+        self.capacity = max(config['samples'], SHAREDSAMPLES)
+        self.context = multiprocessing.get_context('spawn') # no fork of a Qt process
+        self.process = None
+        self.shared = None
+        self.commands = None
+        self.events = None
+        self.connected = None   # None until the process reported the connect
+        self.log = SPSCQueue(10000)
+        self.latency = LatencyStats()
+        self.remotestats = {'lines': 0, 'samples': 0, 'malformed': 0, 'incoming': 0, 'dropped': 0, 'logdropped': 0,
+                            'suppressed': 0}
+        self.overruns = 0       # samples overwritten in the shared buffer before the GUI copied them
+        self.recorder = None    # RemoteRecorder while recording
+        self.local = None       # recorder in this process, see set_recorder()
+        self._showraw = False
+
+    @property
+    def showraw(self):
+        return self._showraw
+
+    @showraw.setter
+    def showraw(self, showraw):
+        self._showraw = showraw
+        self.command('raw', showraw)
+
+    def start(self, address):
+        config = dict(self.config, com=address)
+        self.shared = SharedRingBuffer(self.buffer.channels, self.capacity)
+        self.commands = self.context.Queue()
+        self.events = self.context.Queue()
+        self.connected = None
+        self.process = self.context.Process(target=acquisition_process, daemon=True,
+                                            args=(config, self.shared.name, self.capacity, self.commands, self.events))
+        self.process.start()
+        self.command('raw', self._showraw)
+
+    def open_transport(self, address):
+        # blocks until the process opened the port or socket (or failed to)
+        self.start(address)
+        self.wait_for('connected')
+        return self.connected
+
+    def start_ble(self):
+        pass # the process is started by RemoteBLE.connect_to_device, it has the address
+
+    async def connect_ble(self, address):
+        self.start(F"Address {address}")
+        while self.connected is None and self.process.is_alive():
+            self.poll_events()
+            await asyncio.sleep(0.05)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.command('stop')
+        self.wait_for('stopped', timeout=10)
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.poll()
+        self.process = None
+        self.shared.close()
+        self.shared.unlink()
+        self.shared = None
+        self.connected = None
+
+    def isRunning(self):
+        return self.process is not None and self.process.is_alive()
+
+    def get_log(self):
+        return self.log.get_all() # one producer: this (the GUI) thread, see poll()
+
+    def command(self, kind, argument=None):
+        if self.process is not None:
+            self.commands.put((kind, argument))
+
+    def feed(self, data):
+        pass # BLE notifications arrive in the acquisition process
+
+    def write(self, data):
+        self.command('write', data)
+
+    def set_recorder(self, recorder):
+        # a RemoteRecorder records in the acquisition process, any other recorder (e.g. a MergedRecorder
+        # source) here, with the samples copied by poll(). those are only complete if the GUI keeps up,
+        # and they are the "filterplot" columns, not the "filtercsv" ones
+        self.local = None if isinstance(recorder, RemoteRecorder) else recorder
+
+    def poll(self):
+        # GUI thread, every frame: log and stats from the process, new samples into the Widget's buffer
+        self.poll_events()
+        if self.shared is None:
+            return
+        values, lost, arrival, stored = self.shared.read()
+        self.overruns += lost
+        if lost:
+            self.log.put(F'[-PC-] Error: display too slow, {lost} samples not plotted' +
+                         (' and not recorded' if self.local is not None else ' (still recorded)'))
+        if len(values):
+            with self.lock:
+                self.buffer.write(values)
+                if self.local is not None:
+                    self.local.put(values, stored or None)
+                if stored: # the times of the batches copied here are approximated by those of the newest
+                    self.latency.arrival_parse.add((stored - arrival) * 1000, len(values))
+                    self.latency.pending.append((arrival, stored, len(values)))
+
+    def poll_events(self, kinds=()):
+        # handles all events, returns True if one of <kinds> was among them
+        found = False
+        if self.events is None:
+            return found
+        while True:
+            try:
+                kind, argument = self.events.get_nowait()
+            except queue.Empty:
+                return found
+            found = found or kind in kinds
+            if kind == 'log':
+                self.log.put(argument)
+            elif kind == 'connected':
+                self.connected = argument
+            elif kind == 'stats':
+                self.remotestats = argument['acquisition']
+                if self.recorder is not None:
+                    self.recorder.bytes_written = argument['csvbytes']
+                    self.recorder.queued = argument['csvqueue']
+                    self.recorder.error = argument['csverror']
+            elif kind == 'csv' and self.recorder is not None:
+                self.recorder.opened = argument
+            elif kind == 'csvstop' and self.recorder is not None:
+                self.recorder.bytes_written = argument
+
+    def wait_for(self, kind, timeout=5.0):
+        # blocks the GUI for short handshakes only (port open, CSV file open/close)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and self.process.is_alive():
+            if self.poll_events((kind,)):
+                return True
+            time.sleep(0.01)
+        return self.poll_events((kind,))
+
+    def stats(self):
+        return dict(self.remotestats, overruns=self.overruns)
+
+
+class RemoteRecorder:
+    # CSVRecorder interface for recording in the acquisition process
+    def __init__(self, acquisition, filename):
+        self.acquisition = acquisition
+        self.filename = filename
+        self.bytes_written = 0
+        self.queued = 0
+        self.error = None       # text of the error that ended the recording in the acquisition process
+        self.opened = None
+        if acquisition.process is None:
+            raise OSError('not connected')
+        acquisition.recorder = self
+        acquisition.command('csv', filename)
+        acquisition.wait_for('csv')
+        if not self.opened:
+            acquisition.recorder = None
+            raise OSError(F'could not open {filename}')
+
+    def queue_depth(self):
+        return self.queued
+
+    def close(self):
+        if self.acquisition.isRunning():
+            self.acquisition.command('csvstop')
+            self.acquisition.wait_for('csvstop')
+        self.acquisition.poll_events()
+        self.acquisition.recorder = None
+
+
+class RemoteBLE:
+    # SDP_BLE.BLE interface: the connection is made by the acquisition process
+    def __init__(self, acquisition):
+        self.acquisition = acquisition
+        self.client = None
+
+    async def connect_to_device(self, address, receiver):
+        await self.acquisition.connect_ble(address)
+        return bool(self.acquisition.connected)
+
+    async def disconnect(self):
+        pass # done by the acquisition process when it stops
+
+    async def send_data(self, data):
+        self.acquisition.write(data)
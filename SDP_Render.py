@@ -0,0 +1,70 @@
+# Project: Serial Data Plotter
+# render scheduling for SerialDataPlotter.py
+#
+# update_plot asks the scheduler what to do on every timer tick:
+# - curves and Y ranges are only redrawn if samples were written since the last frame
+# - the live value labels are updated together, at most every labelinterval ms
+# - the timer interval adapts to data rate and measured frame cost:
+#   never shorter than "refresh" ms, at least 4 times the frame cost (so the GUI
+#   keeps time for user input), about half the time between incoming batches,
+#   and growing up to "maxrefresh" ms while no data arrives
+
+import time
+
+
+class RenderScheduler:
+    def __init__(self, refresh, maxrefresh, labelinterval=200):
+        self.refresh = refresh
+        self.maxrefresh = max(refresh, maxrefresh)
+        self.labelinterval = labelinterval
+        self.interval = refresh     # current timer interval in ms
+        self.written = None         # RingBuffer.written at the last drawn frame
+        self.cost = 0.0             # smoothed frame cost in ms, including the repaint after update_plot
+        self.lastcost = 0.0         # duration of the last update_plot in ms
+        self.dataperiod = 0.0       # smoothed time between frames with new data in ms
+        self.lasttick = None
+        self.lastdata = None
+        self.lastlabels = 0.0
+        self.labelwritten = None    # RingBuffer.written when the labels were updated
+        self.lastdirty = False
+
+    def tick(self, written):
+        # start of a frame: returns True if samples were written since the last drawn frame
+        now = time.perf_counter()
+        if self.lasttick is not None and self.lastdirty:
+            # the time the timer fired late was spent repainting the last frame (or on other GUI work)
+            lag = max(0.0, (now - self.lasttick) * 1000 - self.interval)
+            self.cost += 0.2 * (self.lastcost + lag - self.cost)
+        self.lasttick = now
+        dirty = written != self.written
+        if dirty:
+            if self.lastdata is not None:
+                self.dataperiod += 0.2 * ((now - self.lastdata) * 1000 - self.dataperiod)
+            self.lastdata = now
+            self.written = written
+        self.lastdirty = dirty
+        return dirty
+
+    def labels_due(self):
+        # True if the labels are outdated and were not updated for labelinterval ms
+        now = time.perf_counter()
+        if self.labelwritten != self.written and (now - self.lastlabels) * 1000 >= self.labelinterval:
+            self.lastlabels = now
+            self.labelwritten = self.written
+            return True
+        return False
+
+    def done(self):
+        # end of a frame: returns the timer interval for the next frame
+        self.lastcost = (time.perf_counter() - self.lasttick) * 1000
+        if self.lastdirty:
+            interval = max(self.refresh, 4 * self.cost, min(self.dataperiod / 2, self.maxrefresh))
+        else: # nothing new, slow down
+            interval = self.interval * 1.5
+        self.interval = int(min(max(interval, self.refresh), self.maxrefresh))
+        return self.interval
+
+    def reset(self):
+        # force a redraw with the next frame
+        self.written = None
+        self.labelwritten = None
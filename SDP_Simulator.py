@@ -0,0 +1,245 @@
+# Project: Serial Data Plotter
+# device simulator for testing and benchmarking SerialDataPlotter.py without hardware
+#
+# sends "plots" channels (sine waves of different frequency plus a sample counter in the last
+# field) at "rate" samples per second, as text lines or binary records like the config describes
+# ("format", "delimiter", "binaryformat", "syncbytes", "crc", see SDP_Parser.py). derived channels
+# ("expression") are not sent, the plotter computes them:
+# - Simulator.open_pty(): over a Linux pseudo-terminal, the printed port name goes into "com"
+# - FakeBLE: drop-in replacement for SDP_BLE.BLE, sends notifications of at most mtu-3 bytes
+#   to the receiver of connect_to_device(), like a Nordic UART device: the stream is cut anywhere,
+#   or, with wholelines, after complete lines only
+# a fraction of the records can be corrupted ("malformed") to exercise the error paths.
+#
+# e.g.: python SDP_Simulator.py --config myconfig.json --rate 20000
+
+import argparse
+import asyncio
+import binascii
+import os
+import threading
+import time
+import numpy as np
+
+import SDP_Config as SDP
+from SDP_Parser import BinaryParser
+from SDP_Derived import inputchannels
+
+
+class Simulator:
+    def __init__(self, config, rate=1000, malformed=0.0, chunkinterval=0.01, seed=0):
+        self.config = config
+        self.rate = rate                    # samples per second, 0: as fast as possible
+        self.malformed = malformed          # fraction of corrupted records
+        self.chunkinterval = chunkinterval  # seconds between writes
+        self.channels = len(inputchannels(config))
+        self.binary = config['format'] == 'binary'
+        if self.binary:
+            parser = BinaryParser(config)
+            self.dtype = parser.dtype
+            self.fields = parser.fields
+            self.sync = parser.sync
+            self.crc = parser.crc
+            self.crcdtype = parser.crcdtype
+        self.random = np.random.default_rng(seed)
+        self.sent = 0           # samples sent, including malformed ones
+        self.bytes_sent = 0
+        self.running = False
+        self.started = None     # time.monotonic() of the first chunk
+        self.thread = None
+        self.master = None      # pty master fd, the device side
+        self.slave = None       # pty slave fd, kept open so the port stays usable between connects
+        self.port = None        # pty slave name, for "com"
+
+    def values(self, n):
+        # n samples x channels: sine waves, the last channel counts the samples
+        t = np.arange(self.sent, self.sent + n, dtype=np.float64)
+        values = np.empty((n, self.channels))
+        for i in range(self.channels):
+            values[:, i] = 100 * np.sin(2 * np.pi * t / (50 * (i + 1)))
+        values[:, -1] = t
+        return values
+
+    def encode(self, values):
+        # samples -> bytes as sent by the device
+        corrupt = self.random.random(len(values)) < self.malformed if self.malformed else None
+        if not self.binary:
+            rowformat = self.config['delimiter'].join(['%.4f'] * self.channels) + '\r\n'
+            lines = (rowformat * len(values)) % tuple(values.ravel().tolist())
+            if corrupt is not None and corrupt.any():
+                lines = lines.split('\r\n')
+                for i in np.flatnonzero(corrupt):
+                    lines[i] = lines[i].replace(self.config['delimiter'], ' ', 1)
+                lines = '\r\n'.join(lines)
+            return lines.encode()
+        records = np.zeros(len(values), dtype=self.dtype)
+        for i, name in enumerate(self.fields): # surplus fields repeat the channels
+            records[name] = values[:, i % self.channels]
+        payload = records.tobytes()
+        size = self.dtype.itemsize
+        frames = bytearray()
+        for i in range(len(values)):
+            record = payload[i*size:(i+1)*size]
+            frames += self.sync + record
+            if self.crc:
+                crc = binascii.crc_hqx(record, 0xFFFF) ^ (1 if corrupt is not None and corrupt[i] else 0)
+                frames += np.array(crc, dtype=self.crcdtype).tobytes()
+        return bytes(frames)
+
+    def generate(self, n):
+        data = self.encode(self.values(n))
+        self.sent += n
+        self.bytes_sent += len(data)
+        return data
+
+    def chunks(self, count=None):
+        # yields the data due, paced to "rate", until stop() or <count> samples.
+        # b'' if nothing is due yet: the caller waits chunkinterval (in a thread or the event loop)
+        start = self.started = time.monotonic()
+        while self.running and (count is None or self.sent < count):
+            if self.rate:
+                due = int((time.monotonic() - start) * self.rate) - self.sent
+                if due <= 0:
+                    yield b''
+                    continue
+            else:
+                due = 10000
+            if count is not None:
+                due = min(due, count - self.sent)
+            yield self.generate(due)
+
+    def open_pty(self):
+        # Linux/macOS only: returns the name of the port to connect to
+        import pty
+        import tty
+        self.master, slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self.slave = slave
+        return self.port
+
+    def start(self, count=None):
+        # writes to the pty from a thread, commands from the plotter are read and discarded
+        self.running = True
+        self.thread = threading.Thread(target=self.run, args=(count,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self, count=None):
+        os.set_blocking(self.master, False)
+        for data in self.chunks(count):
+            if not data:
+                time.sleep(self.chunkinterval)
+            view = memoryview(data)
+            deadline = None
+            while len(view): # a chunk is counted as sent, so it is finished even after stop()
+                try:
+                    view = view[os.write(self.master, view):]
+                except BlockingIOError: # nobody is reading fast enough, the pty buffer is full
+                    if not self.running: # give up if nobody reads at all
+                        deadline = deadline or time.monotonic() + 1.0
+                        if time.monotonic() > deadline:
+                            break
+                    time.sleep(0.001)
+                self.discard_input()
+        self.running = False
+
+    def discard_input(self):
+        try:
+            os.read(self.master, 65536)
+        except (BlockingIOError, OSError):
+            pass
+
+    def close(self):
+        self.stop()
+        if self.master is not None:
+            os.close(self.master)
+            os.close(self.slave)
+            self.master = None
+
+
+class FakeBLE:
+    # same interface as SDP_BLE.BLE, data comes from a Simulator instead of a device
+    def __init__(self, simulator, mtu=247, wholelines=False):
+        self.simulator = simulator
+        self.mtu = mtu
+        self.wholelines = wholelines
+        self.client = None      # the sending task while "connected"
+        self.notifications = 0
+        self.commands = []      # received commands (bytes)
+
+    async def scan_for_devices(self):
+        return []
+
+    async def connect_to_device(self, address, receiver):
+        self.simulator.running = True
+        self.client = asyncio.ensure_future(self.notify(receiver))
+        return True
+
+    async def notify(self, receiver):
+        # as many bytes as fit into one notification, with wholelines as many complete text lines
+        size = self.mtu - 3
+        pending = b''
+        for data in self.simulator.chunks():
+            if not data:
+                await asyncio.sleep(self.simulator.chunkinterval)
+                continue
+            data = pending + data
+            pending = b''
+            pos = 0
+            while len(data) - pos > size:
+                end = pos + size
+                if self.wholelines and not self.simulator.binary:
+                    end = data.rfind(b'\n', pos, end) + 1
+                    if end <= pos: # line longer than a notification, split it
+                        end = pos + size
+                receiver(self, bytearray(data[pos:end]))
+                self.notifications += 1
+                pos = end
+            pending = data[pos:]
+            await asyncio.sleep(0) # let the event loop (GUI) run between chunks
+        if pending:
+            receiver(self, bytearray(pending))
+            self.notifications += 1
+
+    async def disconnect(self):
+        self.simulator.running = False
+        if self.client is not None:
+            await self.client
+            self.client = None
+
+    async def send_data(self, data):
+        self.commands.append(bytes(data))
+
+    def notification_handler(self, sender, data):
+        print(f"Received data: {data}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulates a device on a pseudo-terminal')
+    parser.add_argument("--config", help="config file (plots, format, delimiter, binaryformat, ...)", default=None)
+    parser.add_argument("--plots", type=int, help="Number of channels", default=None)
+    parser.add_argument("--rate", type=float, help="samples per second, 0: as fast as possible", default=1000)
+    parser.add_argument("--malformed", type=float, help="fraction of corrupted records", default=0.0)
+    parser.add_argument("--count", type=int, help="samples to send, default: until Ctrl+C", default=None)
+
+    args = parser.parse_args()
+    config = SDP.loadconfig(args.config)
+    if args.plots is not None:
+        config['plots'] = args.plots
+    simulator = Simulator(config, args.rate, args.malformed)
+    print(F'Simulating {len(inputchannels(config))} channels ({config["format"]}) at {args.rate:g} samples/s on {simulator.open_pty()}')
+    simulator.start(args.count)
+    try:
+        while simulator.running:
+            time.sleep(1)
+            print(F'{simulator.sent} samples, {simulator.bytes_sent} bytes sent', flush=True)
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
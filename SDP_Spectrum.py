@@ -0,0 +1,88 @@
+# Project: Serial Data Plotter
+# spectrum (power spectral density) of the channels for the "Spectrum" tab of SerialDataPlotter.py
+#
+# Welch's method, computed incrementally in a background thread: the GUI hands over only the
+# samples written since the last time, and only once at least one new segment is complete
+# ("fftsize" samples, a new one every fftsize * (1 - "fftoverlap") samples). every segment is
+# detrended (mean), Hann windowed and transformed once, its periodogram is added to a running
+# sum over the newest "fftaverages" segments, so a new spectrum costs one FFT per new segment.
+# with "samplerate" set the frequency axis is in Hz and the PSD in unit^2/Hz, otherwise in
+# cycles per sample (with "decimate" filters on all channels the plotted rate is lower, see
+# SDP_Filter.py). if the GUI falls behind by more than the buffer, the averaging restarts.
+
+from collections import deque
+import queue
+import threading
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from SDP_Acquisition import SPSCQueue
+
+FFTSIZES = [2**n for n in range(6, 17)] # 64 ... 65536
+
+
+def nearestfftsize(size):
+    # the entry of FFTSIZES closest to <size> (on a log scale), e.g. 1000 -> 1024
+    return min(FFTSIZES, key=lambda fftsize: abs(np.log2(fftsize) - np.log2(max(1, int(size)))))
+
+
+class Spectrum(threading.Thread):
+    def __init__(self, channels, fftsize=1024, overlap=0.5, averages=8, samplerate=None):
+        super().__init__(daemon=True)
+        self.channels = channels
+        self.samplerate = samplerate or 1.0
+        self.queue = queue.Queue()      # ('data', channels x samples, gap) or ('configure', ...) or None
+        self.results = SPSCQueue(16)    # (frequencies, PSD channels x bins in dB, segments averaged)
+        self.configure(fftsize, overlap, averages)
+        self.start()
+
+    def configure(self, fftsize, overlap, averages):
+        # GUI thread: new settings, the averaging starts again
+        self.fftsize = int(fftsize)
+        self.hop = max(1, int(round(self.fftsize * (1 - overlap))))
+        self.queue.put(('configure', (self.fftsize, self.hop, int(averages))))
+
+    def feed(self, values, gap=False):
+        # GUI thread: new samples (channels x samples) in order, gap if samples are missing before them
+        self.queue.put(('data', values, gap))
+
+    def busy(self):
+        return self.queue.qsize() > 0
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        fftsize = hop = averages = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, *arguments = item
+            if kind == 'configure':
+                fftsize, hop, averages = arguments[0]
+                window = np.hanning(fftsize)
+                scale = 1.0 / (self.samplerate * np.sum(window**2))
+                frequencies = np.fft.rfftfreq(fftsize, 1.0 / self.samplerate)
+                tail = np.empty((self.channels, 0))  # samples not used by a complete segment yet
+                periodograms = deque()               # channels x bins of the newest segments
+                total = np.zeros((self.channels, len(frequencies)))
+                continue
+            values, gap = arguments
+            tail = values if gap else np.hstack((tail, values))
+            if tail.shape[1] < fftsize:
+                continue
+            segments = sliding_window_view(tail, fftsize, axis=1)[:, ::hop] # channels x segments x fftsize
+            tail = tail[:, segments.shape[1] * hop:]
+            segments = segments[:, -averages:]
+            segments = (segments - segments.mean(axis=2, keepdims=True)) * window
+            power = np.abs(np.fft.rfft(segments, axis=2))**2 * scale
+            power[:, :, 1:(fftsize + 1) // 2] *= 2 # one-sided: the negative frequencies
+            for i in range(power.shape[1]):
+                periodograms.append(power[:, i])
+                total += power[:, i]
+                if len(periodograms) > averages:
+                    total -= periodograms.popleft()
+            psd = 10 * np.log10(np.maximum(total / len(periodograms), 1e-300)) # the running sum can get slightly < 0
+            self.results.put((frequencies, psd, len(periodograms)))
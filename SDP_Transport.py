@@ -0,0 +1,403 @@
+# Project: Serial Data Plotter
+# transports for the acquisition thread of SerialDataPlotter.py (SDP_Acquisition.py)
+#
+# every transport delivers batches of bytes with their arrival time (time.perf_counter), so all
+# of them share the same reassembly, parsing, filtering and recording. "com" selects one:
+#   COM3, /dev/ttyUSB0          serial port (115200 baud)
+#   Address <device address>    BLE (Nordic UART), connected by SDP_BLE.BLE in the GUI thread
+#   tcp://<host>:<port>         TCP client, e.g. an Ethernet-to-serial bridge
+#   tcpserver://[<host>]:<port> TCP server, one client at a time, the next one may connect later
+#   udp://[<host>]:<port>       UDP, receives on <port>, commands go to the sender of the last datagram
+#   pipe://<path>               named pipe (FIFO, or \\.\pipe\<name> on Windows), read only
+#   replay://<file>[?speed=<factor>&rate=<records/s>&loop=1]
+#                               replays a recording (see ReplayTransport), read only
+# open() is called by the thread starting the acquisition and raises OSError, all other methods
+# are only called by the acquisition thread. read() waits at most <timeout> seconds and raises
+# OSError if the connection is gone for good (EOFError at the end of a replay).
+# packets: every read is one packet (BLE notification, UDP datagram), see LineParser.packet.
+
+from collections import deque
+import mmap
+import os
+import queue
+import select
+import socket
+import threading
+import time
+import urllib.parse
+import numpy as np
+from PyQt5 import QtCore, QtSerialPort
+
+
+def gettransport(address, worker=None):
+    # transport for "com" = <address>, worker: the AcquisitionWorker (for BLE)
+    if "Address" in address:
+        return BLETransport(worker)
+    scheme, _, location = address.partition('://')
+    if not location:
+        return SerialTransport(address)
+    if scheme == 'replay':
+        return ReplayTransport(location, worker)
+    if scheme not in TRANSPORTS:
+        raise OSError(F'unknown transport "{scheme}://", known: {", ".join(name + "://" for name in TRANSPORTS)}')
+    return TRANSPORTS[scheme](location)
+
+
+def hostport(location, defaulthost=''):
+    # "host:port" or ":port" -> (host, port)
+    host, _, port = location.rpartition(':')
+    try:
+        return host.strip('[]') or defaulthost, int(port)
+    except ValueError:
+        raise OSError(F'"{location}" is not <host>:<port>') from None
+
+
+class Transport:
+    packets = False
+
+    def open(self):
+        pass
+
+    def attach(self, thread):
+        # called after open() with the acquisition thread
+        pass
+
+    def read(self, timeout):
+        # -> list of (arrival, bytes), empty if nothing arrived within <timeout> seconds
+        raise NotImplementedError
+
+    def write(self, data):
+        raise OSError(F'{type(self).__name__} can not send')
+
+    def close(self):
+        pass
+
+
+class SerialTransport(Transport):
+    # blocking reads, see the Qt "blocking receiver" example
+    def __init__(self, address):
+        self.address = address
+        self.port = None
+
+    def open(self):
+        port = QtSerialPort.QSerialPort(self.address, baudRate=QtSerialPort.QSerialPort.Baud115200)
+        if not port.open(QtCore.QIODevice.ReadWrite):
+            raise OSError(port.errorString())
+        self.port = port
+
+    def attach(self, thread):
+        self.port.moveToThread(thread) # from now on it is used by this thread only
+
+    def read(self, timeout):
+        if self.port.waitForReadyRead(int(timeout * 1000)):
+            arrival = time.perf_counter()
+            return [(arrival, self.port.readAll().data())]
+        if self.port.error() == QtSerialPort.QSerialPort.ResourceError:
+            raise OSError(self.port.errorString())
+        return []
+
+    def write(self, data):
+        self.port.write(data)
+        self.port.waitForBytesWritten(100)
+
+    def close(self):
+        self.port.close()
+
+
+class BLETransport(Transport):
+    # the notifications are queued by AcquisitionWorker.feed() in the asyncio loop, sending is done
+    # by SDP_BLE.BLE there too
+    packets = True
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def read(self, timeout):
+        self.worker.wakeup.wait(timeout)
+        self.worker.wakeup.clear()
+        return self.worker.incoming.get_all()
+
+
+class TCPClientTransport(Transport):
+    def __init__(self, location):
+        self.address = hostport(location, 'localhost')
+        self.socket = None
+
+    def open(self):
+        self.socket = socket.create_connection(self.address, timeout=5)
+
+    def read(self, timeout):
+        self.socket.settimeout(timeout)
+        try:
+            data = self.socket.recv(65536)
+        except socket.timeout:
+            return []
+        if not data:
+            raise OSError(F'connection closed by {self.address[0]}:{self.address[1]}')
+        return [(time.perf_counter(), data)]
+
+    def write(self, data):
+        self.socket.settimeout(1.0)
+        self.socket.sendall(data)
+
+    def close(self):
+        self.socket.close()
+
+
+class TCPServerTransport(Transport):
+    def __init__(self, location):
+        self.address = hostport(location)
+        self.server = None
+        self.client = None
+
+    def open(self):
+        self.server = socket.create_server(self.address)
+
+    def read(self, timeout):
+        if self.client is None:
+            if not select.select([self.server], [], [], timeout)[0]:
+                return []
+            self.client, _ = self.server.accept()
+            return [] # the next read() waits for its data
+        self.client.settimeout(timeout)
+        try:
+            data = self.client.recv(65536)
+        except socket.timeout:
+            return []
+        except ConnectionError: # e.g. reset by the client: wait for the next one
+            data = b''
+        if not data:
+            self.client.close()
+            self.client = None
+            return []
+        return [(time.perf_counter(), data)]
+
+    def write(self, data):
+        if self.client is None:
+            raise OSError('no client connected')
+        self.client.settimeout(1.0)
+        self.client.sendall(data)
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        self.server.close()
+
+
+class UDPTransport(Transport):
+    packets = True
+
+    def __init__(self, location):
+        self.address = hostport(location)
+        self.socket = None
+        self.peer = None    # sender of the last datagram, gets the commands
+
+    def open(self):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024) # bursts at high rates
+        self.socket.bind(self.address)
+
+    def read(self, timeout):
+        if not select.select([self.socket], [], [], timeout)[0]:
+            return []
+        arrival = time.perf_counter()
+        datagrams = []
+        self.socket.setblocking(False)
+        try:
+            while True: # everything already waiting, as one batch
+                data, self.peer = self.socket.recvfrom(65536)
+                datagrams.append((arrival, data))
+        except (BlockingIOError, InterruptedError):
+            pass
+        finally:
+            self.socket.setblocking(True)
+        return datagrams
+
+    def write(self, data):
+        if self.peer is None:
+            raise OSError('nothing received yet, sender unknown')
+        self.socket.sendto(data, self.peer)
+
+    def close(self):
+        self.socket.close()
+
+
+class PipeTransport(Transport):
+    # POSIX: non-blocking FIFO, waiting for a writer does not block. Windows: the pipe is read by a
+    # helper thread, named pipes can't be waited for with select()
+    def __init__(self, location):
+        self.path = location
+        self.fd = None
+        self.file = None
+        self.queue = None
+
+    def open(self):
+        if os.name == 'nt':
+            self.file = open(self.path, 'rb', buffering=0)
+            self.queue = queue.Queue()
+            threading.Thread(target=self.reader, daemon=True).start()
+        else:
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+
+    def reader(self):
+        try:
+            while True:
+                data = self.file.read(65536)
+                self.queue.put((time.perf_counter(), data))
+                if not data:
+                    break
+        except (OSError, ValueError): # closed
+            self.queue.put((time.perf_counter(), b''))
+
+    def read(self, timeout):
+        if self.queue is not None:
+            try:
+                arrival, data = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return []
+            if not data:
+                raise OSError(F'{self.path} closed by the writer')
+            return [(arrival, data)]
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 65536)
+        if not data: # no writer (yet, or any more): select() returns at once until one opens the FIFO
+            time.sleep(timeout)
+            return []
+        return [(time.perf_counter(), data)]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+        if self.fd is not None:
+            os.close(self.fd)
+
+
+class ReplayTransport(Transport):
+    # a CSV recorded by SerialDataPlotter (the header line is skipped, ";" becomes "delimiter") or a
+    # capture of the raw device output (text lines, or binary records with "format": "binary"),
+    # streamed like a live device: <speed> times "rate" (or "samplerate") records per second,
+    # speed 0 or no rate known: as fast as the plotter takes them. a CSV holds the values after
+    # offset, scale_factor, derived channels and filters, so replay it with a config without those.
+    # pause(), seek() and setspeed() may be called by the GUI thread while replaying. at the end it
+    # raises EOFError, or with worker.holdreplay (the GUI) it pauses: a seek or unpause continues
+    CHUNK = 10000   # records per read at most
+
+    def __init__(self, location, worker):
+        path, _, query = location.partition('?')
+        options = {key: values[-1] for key, values in urllib.parse.parse_qs(query).items()}
+        try:
+            self.speed = float(options.get('speed', 1))
+            self.rate = float(options.get('rate') or worker.config['samplerate'] or 0)
+        except ValueError as e:
+            raise OSError(F'replay options: {e}') from None
+        self.loop = options.get('loop', '0').lower() not in ('0', 'false', 'no')
+        self.hold = getattr(worker, 'holdreplay', False) # at the end: pause instead of EOFError
+        self.path = path
+        self.framesize = worker.parser.framesize if worker.config['format'] == 'binary' else None
+        self.delimiter = worker.config['delimiter'].encode()
+        self.csv = path.lower().endswith('.csv') and self.framesize is None
+        self.commands = deque() # (method, argument) from the GUI thread, append and popleft are atomic
+        self.paused = False
+        self.ended = False      # paused by the end (hold)
+        self.file = None
+        self.data = None        # the file, memory mapped
+        self.ends = None        # text: end offset of every line
+        self.first = 0          # first record (after the CSV header)
+        self.records = 0
+        self.position = 0       # next record
+        self.restart()
+
+    def open(self):
+        self.file = open(self.path, 'rb')
+        if not os.fstat(self.file.fileno()).st_size:
+            self.file.close()
+            raise OSError(F'{self.path} is empty')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.framesize is not None:
+            self.records = len(self.data) // self.framesize
+        else:
+            self.ends = np.flatnonzero(np.frombuffer(self.data, dtype=np.uint8) == ord('\n')) + 1
+            if not len(self.ends) or self.ends[-1] != len(self.data): # last line without line end
+                self.ends = np.append(self.ends, len(self.data))
+            self.records = len(self.ends)
+            if self.csv:
+                header = self.data[:self.ends[0]].split(b';')[0]
+                try:
+                    float(header)
+                except ValueError:
+                    self.first = 1
+        self.position = self.first
+        self.restart()
+
+    def offset(self, record):
+        if self.framesize is not None:
+            return record * self.framesize
+        return int(self.ends[record - 1]) if record else 0
+
+    def restart(self):
+        # pacing starts again from the current position
+        self.starttime = time.monotonic()
+        self.startposition = self.position
+
+    def pause(self, paused):
+        self.commands.append(('pause', paused))
+
+    def seek(self, record):
+        self.commands.append(('seek', record))
+
+    def setspeed(self, speed):
+        self.commands.append(('speed', speed))
+
+    def read(self, timeout):
+        while self.commands:
+            kind, argument = self.commands.popleft()
+            if kind == 'pause':
+                self.paused = argument
+                self.ended = False
+                if not self.paused and self.position >= self.records: # unpaused at the end: start over
+                    self.position = self.first
+            elif kind == 'seek':
+                self.position = min(max(self.first, int(argument)), self.records)
+                if self.ended: # continues from there
+                    self.paused = self.ended = False
+            elif kind == 'speed':
+                self.speed = argument
+            self.restart()
+        if self.paused:
+            time.sleep(timeout)
+            return []
+        if self.position >= self.records:
+            if self.hold and not self.loop: # a seek() continues
+                self.paused = self.ended = True
+                return []
+            if not self.loop:
+                raise EOFError(F'end of replay of {self.path}')
+            self.position = self.first
+            self.restart()
+        due = self.CHUNK
+        if self.speed and self.rate:
+            due = self.startposition + int((time.monotonic() - self.starttime) * self.rate * self.speed) - self.position
+            if due <= 0:
+                time.sleep(min(timeout, 1 / (self.rate * self.speed)))
+                return []
+        end = min(self.position + due, self.position + self.CHUNK, self.records)
+        data = self.data[self.offset(self.position):self.offset(end)]
+        self.position = end
+        if self.csv and self.delimiter != b';':
+            data = data.replace(b';', self.delimiter)
+        return [(time.perf_counter(), data)]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.file.close()
+
+
+TRANSPORTS = {
+    'tcp': TCPClientTransport,
+    'tcpserver': TCPServerTransport,
+    'udp': UDPTransport,
+    'pipe': PipeTransport,
+    'replay': ReplayTransport,
+}
@@ -4,7 +4,6 @@
 # uses Bleak for BLE support
 #
 # ToDo:
-# - add custom filtering
 # - add option and handling for time axis/time stamps
 # won't do - add "save and restart" option in "config" tab
 # done - BLE support
@@ -12,23 +11,33 @@
 # done - add compatibility function for older config files
 # done - add sending a command to device on connect
 # done sending a command to device when starting/stopping writing to csv
+# done - add custom filtering ("filters" of the channels, see SDP_Filter.py)
 #
 # config file is a json file, see SDP_Config.py for structure
 
 import SDP_Config as SDP
 import SDP_BLE as BLE
-from SDP_BLE import BLEScannerWindow
+from SDP_Buffer import RingBuffer
+from SDP_Acquisition import AcquisitionWorker
+from SDP_Recorder import CSVRecorder
+from SDP_Render import RenderScheduler
+from SDP_Latency import dumpstats
+from SDP_Filter import outputlabels
+from SDP_Spectrum import Spectrum, FFTSIZES, nearestfftsize
+from SDP_Transport import ReplayTransport
+from SDP_BLEScanner import BLEScannerWindow
 
 import asyncio
 from qasync import QEventLoop, asyncSlot
 
 #import pyqtgraph.Qt
-from PyQt5 import QtCore, QtWidgets, QtSerialPort
+from PyQt5 import QtCore, QtWidgets
 import pyqtgraph as QtGraph
 import pyqtgraph.Qt
+import numpy as np
 import json
-import os
 import argparse
+import time
 
 
 class Widget(QtWidgets.QWidget):
@@ -47,28 +56,51 @@ class Widget(QtWidgets.QWidget):
         self.ble = BLE.BLE()
         self.useBLE = False
         self.connected = False
-        self.serial = None
-        self.file = None
+        self.recorder = None
+        self.replay = None      # ReplayTransport while replaying a recording ("com" = replay://...)
 
-        self.idx = 0
         self.fastautoscale = True if self.config['autoscaleinterval'] > 0 else False
         
-        self.data = []
-        for i in range(self.config['plots']):
-            self.data.append([0]*self.config['samples'])
-            #self.data[i][self.config['samples']-1] = 1
+        # samples of all channels in one array, self.data[i] is a view on channel i.
+        # with "filterplot": "both" the raw channels follow the filtered ones
+        self.buffer = RingBuffer(len(outputlabels(self.config, self.config['filterplot'])), self.config['samples'])
+        self.data = self.buffer.data
+        self.xdata = np.arange(self.config['samples'])
+        # reading, parsing and recording run in the worker thread, the GUI only renders
+        self.acquisition = self.create_acquisition()
+        if self.fastautoscale: # min/max per block of ~sqrt(interval) samples, updated on every write
+            self.autoscale = self.buffer.add_summary(int(self.config['autoscaleinterval']**0.5))
+
+        self.render = RenderScheduler(self.config['refresh'], self.config['maxrefresh'])
+        self.yranges = [None] * self.config['plots']   # last Y range set per plot
+        self.labeltexts = [None] * self.config['plots'] # last live value text per plot
+        self.decimation = None  # BlockSummary with one block per pixel column, see get_curves()
+        self.lastview = None    # view (samples per pixel, first, last sample) of the last drawn frame
+        # Welch spectrum of the plotted channels, computed in its own thread while the "Spectrum" tab is shown
+        self.config['fftsize'] = nearestfftsize(self.config['fftsize']) # one the FFT size selector offers
+        self.spectrum = Spectrum(self.config['plots'], self.config['fftsize'], self.config['fftoverlap'],
+                                 self.config['fftaverages'], self.config['samplerate']) if self.config['spectrum'] else None
+        self.spectrumwritten = 0 # buffer.written when samples were last handed to self.spectrum
 
         self.InitUI()
-        # Set up the timer for updating the plot
+        # Set up the timer for updating the plot, the interval is adapted by self.render
         self.timer = QtCore.QTimer()
         self.timer.setInterval(self.config['refresh'])
         self.timer.timeout.connect(self.update_plot)
         self.timer.start()
+        # stats panel and "statsfile"
+        self.statsfile = SDP.expandpath(self.config['statsfile']) if self.config['statsfile'] else None
+        self.laststatsdump = time.monotonic()
+        self.stats_timer = QtCore.QTimer()
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start()
 
     def InitUI(self):
         self.setWindowTitle(self.config['title'])
         self.ax = []    # list of axes
         self.plt = []   # list of plots
+        self.rawplt = [] # raw data behind the filtered plots, with "filterplot": "both"
         self.label_items = []  # list of label items for live values
         self.margin = 2.5
 
@@ -94,10 +126,12 @@ class Widget(QtWidgets.QWidget):
         )
 
         self.config_te = QtWidgets.QTextEdit(readOnly=True)
-        self.output_te = QtWidgets.QTextEdit(readOnly=True)
+        self.output_te = QtWidgets.QPlainTextEdit(readOnly=True)
+        self.output_te.setMaximumBlockCount(self.config['loglines']) # oldest lines are dropped, memory stays bounded
         self.output_te.mouseDoubleClickEvent = self.clear
         self.output_te.setStyleSheet("font-size: 10pt; color: white; background-color: black; font-family: 'Courier New';")
         self.raw_cb = QtWidgets.QCheckBox('Show Raw Data')
+        self.raw_cb.toggled.connect(lambda checked: setattr(self.acquisition, 'showraw', checked))
 
         self.write_csv_btn = QtWidgets.QPushButton(
             text="Write to CSV:",
@@ -105,6 +139,14 @@ class Widget(QtWidgets.QWidget):
         )
 
         self.csvpath_le = QtWidgets.QLineEdit(self.config['csvpath'])
+        self.csvstatus_lb = QtWidgets.QLabel()
+
+        self.stats_te = QtWidgets.QPlainTextEdit(readOnly=True)
+        self.stats_te.setStyleSheet("font-size: 10pt; font-family: 'Courier New';")
+        self.resetstats_btn = QtWidgets.QPushButton(
+            text="Reset latency stats",
+            clicked=lambda: self.acquisition.latency.reset()
+        )
 
         QtGraph.setConfigOption('background', self.config['background'])  # Set the default background color
         QtGraph.setConfigOption('foreground', self.config['foreground'])
@@ -118,7 +160,12 @@ class Widget(QtWidgets.QWidget):
         
         for i in range(self.config['plots']):
             self.ax.append(self.graph.addPlot(row=i, col=0)) 
-            self.plt.append(self.ax[i].plot(self.data[i][:]))
+            if self.buffer.channels > self.config['plots']: # added first, so it is drawn below
+                self.rawplt.append(self.ax[i].plot(self.xdata, self.data[self.config['plots'] + i]))
+                color = QtGraph.mkColor(self.config['channels'][i]['color'])
+                color.setAlpha(100)
+                self.rawplt[i].setPen(color, width=1)
+            self.plt.append(self.ax[i].plot(self.xdata, self.data[i]))
             self.ax[i].setLabel('left', f'<div style="font-size: 11pt">{self.config["channels"][i]["label"]}<\div>')
             self.ax[i].setXRange(0, self.config['samples'])
             
@@ -148,8 +195,64 @@ class Widget(QtWidgets.QWidget):
         tab_layout = QtWidgets.QVBoxLayout(tab1)
         tab_layout.addWidget(self.graph)  # Assuming self.plot_widget is the plot
 
+        # replay controls, only shown while replaying
+        self.pause_btn = QtWidgets.QPushButton(text="Pause", checkable=True,
+                                               toggled=lambda checked: self.replay.pause(checked))
+        self.speed_cb = QtWidgets.QComboBox()
+        self.speed_cb.addItems(['0.1x', '0.5x', '1x', '2x', '5x', '10x', '100x', 'max'])
+        self.speed_cb.setCurrentText('1x')
+        self.speed_cb.currentTextChanged.connect(
+            lambda text: self.replay.setspeed(0 if text == 'max' else float(text.rstrip('x'))))
+        self.seek_sl = QtWidgets.QSlider(QtCore.Qt.Horizontal, minimum=0, maximum=1000)
+        self.seek_sl.sliderReleased.connect(
+            lambda: self.replay.seek(self.replay.first + self.seek_sl.value() / 1000 * (self.replay.records - self.replay.first)))
+        self.position_lb = QtWidgets.QLabel()
+        self.replay_bar = QtWidgets.QWidget()
+        replay_layout = QtWidgets.QHBoxLayout(self.replay_bar)
+        replay_layout.setContentsMargins(0, 0, 0, 0)
+        replay_layout.addWidget(self.pause_btn)
+        replay_layout.addWidget(self.speed_cb)
+        replay_layout.addWidget(self.seek_sl)
+        replay_layout.addWidget(self.position_lb)
+        self.replay_bar.hide()
+        tab_layout.addWidget(self.replay_bar)
+
         tab_widget.addTab(tab1, "Graph")
 
+        # spectrum tab
+        if self.spectrum is not None:
+            self.spectrum_plot = QtGraph.PlotWidget()
+            self.spectrum_plot.showGrid(x=True, y=True)
+            self.spectrum_plot.addLegend()
+            self.spectrum_plot.setLabel('left', 'PSD (dB)')
+            self.spectrum_plot.setLabel('bottom', 'Frequency (Hz)' if self.config['samplerate'] else 'Frequency (cycles/sample)')
+            self.spectrum_curves = [self.spectrum_plot.plot(pen=QtGraph.mkPen(self.config['channels'][i]['color'], width=1),
+                                                            name=self.config['channels'][i]['label'])
+                                    for i in range(self.config['plots'])]
+            self.fftsize_cb = QtWidgets.QComboBox()
+            self.fftsize_cb.addItems([str(size) for size in FFTSIZES])
+            self.fftsize_cb.setCurrentText(str(self.config['fftsize']))
+            self.fftoverlap_sb = QtWidgets.QSpinBox(suffix=' %', minimum=0, maximum=95, singleStep=5,
+                                                    value=int(self.config['fftoverlap'] * 100))
+            self.fftaverages_sb = QtWidgets.QSpinBox(minimum=1, maximum=1000, value=self.config['fftaverages'])
+            self.fftsize_cb.currentTextChanged.connect(self.configure_spectrum)
+            self.fftoverlap_sb.valueChanged.connect(self.configure_spectrum)
+            self.fftaverages_sb.valueChanged.connect(self.configure_spectrum)
+            self.spectrum_lb = QtWidgets.QLabel()
+
+            tab5 = QtWidgets.QWidget()
+            tab5_layout = QtWidgets.QGridLayout(tab5)
+            tab5_layout.addWidget(self.spectrum_plot, 0, 0, 1, 7)
+            tab5_layout.addWidget(QtWidgets.QLabel("FFT size:"), 1, 0)
+            tab5_layout.addWidget(self.fftsize_cb, 1, 1)
+            tab5_layout.addWidget(QtWidgets.QLabel("Overlap:"), 1, 2)
+            tab5_layout.addWidget(self.fftoverlap_sb, 1, 3)
+            tab5_layout.addWidget(QtWidgets.QLabel("Averages:"), 1, 4)
+            tab5_layout.addWidget(self.fftaverages_sb, 1, 5)
+            tab5_layout.addWidget(self.spectrum_lb, 1, 6)
+
+            tab_widget.addTab(tab5, "Spectrum")
+
         # second tab
         tab2 = QtWidgets.QWidget()
         tab_layout = QtWidgets.QGridLayout(tab2)
@@ -158,6 +261,7 @@ class Widget(QtWidgets.QWidget):
         tab_layout.addWidget(self.scan_ble_btn, 0, 2)
         tab_layout.addWidget(self.write_csv_btn, 1, 0)
         tab_layout.addWidget(self.csvpath_le, 1, 1)
+        tab_layout.addWidget(self.csvstatus_lb, 1, 2)
         tab_layout.addWidget(self.send_btn, 2, 0)
         tab_layout.addWidget(self.message_le, 2, 1)
         tab_layout.addWidget(self.raw_cb, 2, 2)
@@ -177,6 +281,14 @@ class Widget(QtWidgets.QWidget):
 
         tab_widget.addTab(tab3, "Config")
 
+        # Fourth tab
+        tab4 = QtWidgets.QWidget()
+        tab4_layout = QtWidgets.QVBoxLayout(tab4)
+        tab4_layout.addWidget(self.stats_te)
+        tab4_layout.addWidget(self.resetstats_btn)
+
+        tab_widget.addTab(tab4, "Stats")
+
         # Add the tab widget to the main layout
         main_layout.addWidget(tab_widget)
 
@@ -186,20 +298,28 @@ class Widget(QtWidgets.QWidget):
         if self.config['autostart']:
             self.on_toggled(True)
 
+    def create_acquisition(self):
+        # reads, parses and stores into self.buffer, see MultipleSDPLauncher.py for a separate process
+        acquisition = AcquisitionWorker(self.config, self.buffer)
+        acquisition.holdreplay = True # seek or loop back with the replay controls
+        return acquisition
+
+    def source_labels(self):
+        # columns of the samples that reach the recorder
+        return outputlabels(self.config, self.config['filtercsv'])
+
+    def create_recorder(self, filename):
+        return CSVRecorder(filename, self.source_labels(),
+                           flushinterval=self.config['csvflushinterval'],
+                           buffersize=self.config['csvbuffersize'])
+
     def refresh_config(self):
         self.config['csvpath'] = self.csvpath_le.text()
         self.config['com'] = self.comport_le.text()
         self.config_te.setPlainText(json.dumps(self.config, indent=4))
 
     def load_config(self, config_file):
-        if config_file:
-            try:
-                return SDP.parseconfig(config_file)
-            except (json.JSONDecodeError, FileNotFoundError) as e:
-                print(f'Error reading config file "{config_file}": {e}. Using default config.')
-                return SDP.getdefaultconfig()
-        else:
-            return SDP.getdefaultconfig()
+        return SDP.loadconfig(config_file)
 
     def open_ble_scanner(self):
         self.ble_scanner_window = BLEScannerWindow()
@@ -211,36 +331,10 @@ class Widget(QtWidgets.QWidget):
         self.comport_le.setText(F"Address {address}")
  
 
-    #@QtCore.pyqtSlot()
-    def parseLine(self, line):
-        values = line.split(self.config['delimiter'])
-        try:
-            for i in range(self.config['plots']):
-                self.data[i][self.idx] = (float(values[i])-self.config['channels'][i]['offset'])*self.config['channels'][i]['scale_factor']
-            if self.file is not None:
-                for i in range(self.config['plots']-1):
-                    self.file.write(F'{self.data[i][self.idx]};')
-                self.file.write(F"{self.data[self.config['plots']-1][self.idx]}\n")  
-            self.idx += 1         
-        except: # either no float or not (enough) data: just throw to terminal log.
-            self.output_te.append(line.rstrip('\r\n'))
-        if self.idx >= self.config['samples']:
-            self.idx = 0
-
     def receive(self,sender=None,data=None):
-        if self.useBLE:
-            #print(f'data: {data}, Type: {type(data)}')
-            line = data.decode("utf-8") #str(data)#self.ble.client.recv()
-            if self.raw_cb.isChecked():
-                self.output_te.append(line.rstrip('\r\n'))
-            self.parseLine(line)
-        
-        elif self.connected:
-            while self.serial.canReadLine():
-                line = self.serial.readLine().data().decode()
-                if self.raw_cb.isChecked():
-                    self.output_te.append(line.rstrip('\r\n'))
-                self.parseLine(line)
+        # BLE notification handler, parsing is done in the acquisition thread
+        #print(f'data: {data}, Type: {type(data)}')
+        self.acquisition.feed(data)
 
  
     #@QtCore.pyqtSlot()
@@ -248,26 +342,25 @@ class Widget(QtWidgets.QWidget):
     async def send(self):
         if self.connected:
             if self.useBLE:
-                self.ble.send_data(self.message_le.text().encode())
-                self.output_te.append(F'[-PC-] => {self.message_le.text()}')
+                asyncio.ensure_future(self.ble.send_data(self.message_le.text().encode()))
+                self.output_te.appendPlainText(F'[-PC-] => {self.message_le.text()}')
             else:
-                self.serial.write(self.message_le.text().encode() + b'\r\n')
-                self.output_te.append(F'[-PC-] => {self.message_le.text()}')
+                self.acquisition.write(self.message_le.text().encode() + b'\r\n')
+                self.output_te.appendPlainText(F'[-PC-] => {self.message_le.text()}')
         else:
-            self.output_te.append('[-PC-] Error: Not connected')
+            self.output_te.appendPlainText('[-PC-] Error: Not connected')
     
     def sendCommand(self,command):
-        command = command.replace('<date>', QtCore.QDateTime.currentDateTime().toString('yyyy-MM-dd'))\
-                .replace('<time>', QtCore.QDateTime.currentDateTime().toString('hh-mm-ss')) 
+        command = SDP.expandcommand(command)
         if self.connected:
             if self.useBLE:
-                self.ble.send_data(command.encode())
-                self.output_te.append(F'[-PC-] => {command}')
+                asyncio.ensure_future(self.ble.send_data(command.encode()))
+                self.output_te.appendPlainText(F'[-PC-] => {command}')
             else:
-                self.serial.write(command.encode() + b'\r\n')
-                self.output_te.append(F'[-PC-] => {command}')
+                self.acquisition.write(command.encode() + b'\r\n')
+                self.output_te.appendPlainText(F'[-PC-] => {command}')
         else:
-            self.output_te.append('[-PC-] Error: Not connected')
+            self.output_te.appendPlainText('[-PC-] Error: Not connected')
 
     @asyncSlot(bool)
     async def on_toggled(self,checked):
@@ -277,125 +370,285 @@ class Widget(QtWidgets.QWidget):
             address = self.comport_le.text()
             if "Address" in address: # BLE
                 address = address.replace("Address ", "")
-                self.output_te.append(F"[-PC-] Connecting to {address}")
-                await self.ble.connect_to_device(address,self.receive)
-                self.connected = True
+                self.output_te.appendPlainText(F"[-PC-] Connecting to {address}")
+                self.acquisition.start_ble()
                 self.useBLE = True
-            else: # Serial
-                self.serial = QtSerialPort.QSerialPort(
-                    address,
-                    baudRate=QtSerialPort.QSerialPort.Baud115200,
-                    readyRead=self.receive
-                )   
+                if await self.ble.connect_to_device(address,self.receive):
+                    self.connected = True
+                else: # BLE disconnect and acquisition.stop() in on_toggled(False)
+                    self.connect_btn.setChecked(False)
+                    self.output_te.appendPlainText(F"[-PC-]  Failed to connect to {address}")
+            else: # Serial, TCP, UDP or pipe, see SDP_Transport.py
                 self.config['com'] = address
-                if not self.serial.isOpen():
-                    if not self.serial.open(QtCore.QIODevice.ReadWrite):
-                        self.connect_btn.setChecked(False)
-                        self.output_te.append(F"[-PC-]  Failed to connect to {self.config['com']}")
-                    else:
-                        self.connected = True
+                self.useBLE = False
+                if not self.acquisition.open_transport(address): # the transport is owned by the acquisition thread
+                    self.connect_btn.setChecked(False)
+                    self.output_te.appendPlainText(F"[-PC-]  Failed to connect to {self.config['com']}")
+                else:
+                    self.connected = True
+                    self.start_replay(getattr(self.acquisition, 'transport', None)) # not with SDP_Remote
             if self.config['cmdconnect'] is not None and self.connected:
                 self.sendCommand(self.config['cmdconnect'])
         else:
             if self.useBLE:
-                self.output_te.append(F"[-PC-] Disconnecting BLE")
-                self.ble.disconnect()
+                self.output_te.appendPlainText(F"[-PC-] Disconnecting BLE")
+                asyncio.ensure_future(self.ble.disconnect())
                 #self.ble.disconnect()
-            else:
-                self.serial.close()
+            self.acquisition.stop()
             self.connected = False
+            self.start_replay(None)
+            stats = self.acquisition.stats()
+            self.output_te.appendPlainText(F"[-PC-] Received {stats['lines']} lines: {stats['samples']} samples parsed, "
+                                  F"{stats['malformed']} malformed, {stats['dropped']} BLE packets dropped")
        
+    def start_replay(self, transport):
+        # shows the replay controls for a ReplayTransport, hides them for anything else
+        self.replay = transport if isinstance(transport, ReplayTransport) else None
+        if self.replay is not None: # the controls show the options of the replay:// address
+            speed = 'max' if not self.replay.speed or not self.replay.rate else F'{self.replay.speed:g}x'
+            if self.speed_cb.findText(speed) < 0:
+                self.speed_cb.addItem(speed)
+            self.pause_btn.blockSignals(True)
+            self.pause_btn.setChecked(False)
+            self.pause_btn.blockSignals(False)
+            self.speed_cb.blockSignals(True)
+            self.speed_cb.setCurrentText(speed)
+            self.speed_cb.blockSignals(False)
+            self.update_replay()
+        self.replay_bar.setVisible(self.replay is not None)
+
+    def update_replay(self):
+        if self.pause_btn.isChecked() != self.replay.paused and not self.replay.commands: # paused at its end
+            self.pause_btn.blockSignals(True)
+            self.pause_btn.setChecked(self.replay.paused)
+            self.pause_btn.blockSignals(False)
+        if self.seek_sl.isSliderDown():
+            return
+        done = (self.replay.position - self.replay.first) / max(1, self.replay.records - self.replay.first)
+        self.seek_sl.setValue(int(done * 1000))
+        self.position_lb.setText(F'{self.replay.position - self.replay.first} / {self.replay.records - self.replay.first}')
+
     def write_to_csv(self):
-        if self.file is None:
-            filename = self.csvpath_le.text().replace('<home>', os.path.expanduser('~')) \
-                                             .replace('<date>', QtCore.QDateTime.currentDateTime().toString('yyyy-MM-dd')) \
-                                             .replace('<time>', QtCore.QDateTime.currentDateTime().toString('hh-mm-ss')) \
-                                             .replace('/', os.sep)  # for windows compatibility
-            try:
-                self.file =  open(filename, 'w')
-                for i in range(self.config['plots']-1):
-                    self.file.write(F'{self.config["channels"][i]["label"]};')
-                self.file.write(F'{self.config["channels"][self.config["plots"]-1]["label"]}\n')
-                self.output_te.append(F'[-PC-] Writing data to {filename}')
-                self.write_csv_btn.setText('Stop writing')
-                self.setWindowTitle(self.config['title'] + F' - Writing to {filename}')
-                if self.config['cmdstartwritecsv'] is not None:        
-                    self.sendCommand(self.config['cmdstartwritecsv'])
-            except:
-                self.output_te.append(F'[-PC-] Error writing to {filename}')
-                self.file = None
+        if self.recorder is None:
+            self.start_writing(SDP.expandpath(self.csvpath_le.text()))
         else:
-            self.file.close()
-            self.file = None
-            self.output_te.append(F'[-PC-] Stopped writing to CSV')
-            self.write_csv_btn.setText('Write to CSV')
-            self.setWindowTitle(self.config['title'])
-            if self.config['cmdstopwritecsv'] is not None:
-                self.sendCommand(self.config['cmdstopwritecsv'])
+            self.stop_writing()
+
+    def start_writing(self, filename, recorder=None):
+        # recorder: e.g. a source of a MergedRecorder (MultipleSDPLauncher.py), default: a CSV file of its own.
+        # False if it failed, a given <recorder> is not closed then
+        try:
+            self.recorder = self.create_recorder(filename) if recorder is None else recorder
+            self.acquisition.set_recorder(self.recorder)
+            self.output_te.appendPlainText(F'[-PC-] Writing data to {filename}')
+            self.write_csv_btn.setText('Stop writing')
+            self.setWindowTitle(self.config['title'] + F' - Writing to {filename}')
+            if self.config['cmdstartwritecsv'] is not None:        
+                self.sendCommand(self.config['cmdstartwritecsv'])
+        except:
+            self.output_te.appendPlainText(F'[-PC-] Error writing to {filename}')
+            self.acquisition.set_recorder(None)
+            self.recorder = None
+            return False
+        return True
+
+    def stop_writing(self):
+        if self.recorder is None:
+            return
+        self.acquisition.set_recorder(None)
+        self.recorder.close()
+        self.output_te.appendPlainText(F'[-PC-] Stopped writing to CSV ({self.recorder.bytes_written} bytes written)')
+        self.recorder = None
+        self.csvstatus_lb.clear()
+        self.write_csv_btn.setText('Write to CSV')
+        self.setWindowTitle(self.config['title'])
+        if self.config['cmdstopwritecsv'] is not None:
+            self.sendCommand(self.config['cmdstopwritecsv'])
 
 
     def update_plot(self):
+        log = self.acquisition.get_log() # rate limited by the acquisition thread, see "lograte"
+        if log:
+            self.output_te.appendPlainText('\n'.join(log))
+        if self.recorder is not None and self.recorder.error:
+            error = F'Error writing to {self.recorder.filename}: {self.recorder.error}'
+            self.output_te.appendPlainText(F'[-PC-] {error}')
+            self.stop_writing()
+            self.csvstatus_lb.setText(error)
+        if self.recorder is not None:
+            self.csvstatus_lb.setText(F'{self.recorder.bytes_written/1e6:.1f} MB, queue: {self.recorder.queue_depth()}')
+        if self.connected and not self.acquisition.isRunning(): # connection lost, the reason is in the log
+            self.output_te.appendPlainText(F"[-PC-] Connection to {self.config['com']} ended")
+            self.connect_btn.setChecked(False) # same as a disconnect by the user, see on_toggled
         if self.connected:
-            for i in range(self.config['plots']):
-                idx = self.idx - 1
-                if idx < 0:
-                    idx = self.config['samples'] - 1
-                self.plt[i].setData(self.data[i][:])
-
-                if self.config['channels'][i]['min'] is not None and self.config['channels'][i]['max'] is not None:
-                    self.ax[i].setYRange(self.config['channels'][i]['min'], self.config['channels'][i]['max'])
-                else:
-                    if self.fastautoscale:
-                        if idx>self.config['autoscaleinterval']:
-                            newmin = min(self.data[i][idx-self.config['autoscaleinterval']:idx])
-                            newmax = max(self.data[i][idx-self.config['autoscaleinterval']:idx])
-                            if newmax == newmin:
-                                newmax = newmax + 1
-                            margin = (newmax - newmin) / self.margin
-                            self.ax[i].setYRange(newmin - margin, newmax + margin)
-                        else:
-                            if idx > 0:
-                                newmin = min(min(self.data[i][0:idx]),min(self.data[i][idx-self.config['autoscaleinterval']:]))
-                                newmax = max(max(self.data[i][0:idx]),max(self.data[i][idx-self.config['autoscaleinterval']:]))
-                                if newmax == newmin:
-                                    newmax = newmax + 1
-                                margin = (newmax-newmin)/self.margin
-                                self.ax[i].setYRange(newmin-margin,newmax+margin)
-                # Update the text item with the current value
-                current_value = self.data[i][idx]
-                self.label_items[i].setText(f'<div style="font-size: 11pt;color: {self.config["channels"][i]["color"]}">{current_value:.2f}<\div>')
-                
+            # snapshot of cursor and Y ranges, the rows are handed over without copy:
+            # a batch written during the repaint just shows up one frame later
+            with self.buffer.lock:
+                idx = self.buffer.idx - 1
+                written = self.buffer.written
+                batches = self.acquisition.latency.take()
+                if self.fastautoscale:
+                    minima, maxima = self.autoscale.window(self.config['autoscaleinterval'])
+            if idx < 0:
+                idx = self.config['samples'] - 1
+            view = self.get_view() if self.config['decimation'] else None
+            dirty = self.render.tick(written)
+            if dirty or view != self.lastview: # skip everything if nothing new arrived and the view is the same
+                self.lastview = view
+                curves = self.get_curves(view)
+                for i in range(self.config['plots']):
+                    self.plt[i].setData(*curves[i])
+                    if self.rawplt:
+                        self.rawplt[i].setData(*curves[self.config['plots'] + i])
+
+                    if self.config['channels'][i]['min'] is not None and self.config['channels'][i]['max'] is not None:
+                        yrange = (self.config['channels'][i]['min'], self.config['channels'][i]['max'])
+                    elif self.fastautoscale: # newest autoscaleinterval samples, wrapping around
+                        newmin = minima[i]
+                        newmax = maxima[i]
+                        if self.rawplt:
+                            newmin = min(newmin, minima[self.config['plots'] + i])
+                            newmax = max(newmax, maxima[self.config['plots'] + i])
+                        if newmax == newmin:
+                            newmax = newmax + 1
+                        margin = (newmax - newmin) / self.margin
+                        yrange = (newmin - margin, newmax + margin)
+                    else:
+                        yrange = None
+                    if yrange is not None and yrange != self.yranges[i]:
+                        self.ax[i].setYRange(*yrange)
+                        self.yranges[i] = yrange
+                self.acquisition.latency.rendered(batches)
+            if self.render.labels_due(): # Update the text items with the current values, all at once
+                for i in range(self.config['plots']):
+                    text = f'<div style="font-size: 11pt;color: {self.config["channels"][i]["color"]}">{self.data[i][idx]:.2f}<\div>'
+                    if text != self.labeltexts[i]:
+                        self.label_items[i].setText(text)
+                        self.labeltexts[i] = text
+            if self.spectrum is not None:
+                self.update_spectrum()
+            if self.replay is not None:
+                self.update_replay()
+        else:
+            self.render.tick(None)
+        self.timer.setInterval(self.render.done())
+
+    def update_spectrum(self):
+        # draws the newest spectrum, hands the samples written since the last time to the Spectrum thread
+        results = self.spectrum.results.get_all()
+        if results:
+            frequencies, psd, segments = results[-1]
+            for i, curve in enumerate(self.spectrum_curves):
+                curve.setData(frequencies, psd[i])
+            self.spectrum_lb.setText(F'{segments} segments averaged')
+        if not self.spectrum_plot.isVisible() or self.spectrum.busy():
+            return
+        with self.buffer.lock:
+            new = self.buffer.written - self.spectrumwritten
+            if new < self.spectrum.hop: # not enough for a new segment
+                return
+            values = self.buffer.latest(new)[:self.config['plots']]
+            self.spectrumwritten = self.buffer.written
+        self.spectrum.feed(values, gap=new > self.buffer.samples)
+
+    def configure_spectrum(self):
+        self.config['fftsize'] = int(self.fftsize_cb.currentText())
+        self.config['fftoverlap'] = self.fftoverlap_sb.value() / 100
+        self.config['fftaverages'] = self.fftaverages_sb.value()
+        self.spectrum.configure(self.config['fftsize'], self.config['fftoverlap'], self.config['fftaverages'])
+        self.spectrum_lb.clear()
+
+    def get_stats(self):
+        # everything for the stats panel and "statsfile"
+        return {'acquisition': self.acquisition.stats(),
+                'render': {'interval': self.render.interval, 'cost': round(self.render.cost, 3),
+                           'dataperiod': round(self.render.dataperiod, 3)},
+                'csvqueue': self.recorder.queue_depth() if self.recorder is not None else None,
+                'latency': self.acquisition.latency.summary()}
+
+    def update_stats(self):
+        stats = self.get_stats()
+        if self.stats_te.isVisible():
+            acquisition = stats['acquisition']
+            self.stats_te.setPlainText(
+                F"received: {acquisition['lines']} lines, {acquisition['samples']} samples parsed, "
+                F"{acquisition['malformed']} malformed, {acquisition['dropped']} BLE packets dropped, "
+                F"{acquisition['incoming']} BLE packets queued, {acquisition['suppressed']} log lines suppressed\n"
+                F"render:   timer interval {self.render.interval} ms (refresh {self.config['refresh']} ms), "
+                F"frame cost {self.render.cost:.2f} ms, new data every {self.render.dataperiod:.1f} ms\n"
+                F"latency:\n" + self.acquisition.latency.text())
+        if self.statsfile and self.config['statsinterval'] and \
+                time.monotonic() - self.laststatsdump >= self.config['statsinterval']:
+            self.laststatsdump = time.monotonic()
+            try:
+                dumpstats(self.statsfile, stats)
+            except OSError as e:
+                self.output_te.appendPlainText(F"[-PC-] Error writing stats to {self.statsfile}: {e}")
+                self.statsfile = None
+
+    def get_view(self):
+        # samples per pixel (power of 2) and visible samples of the (linked) x axes
+        (x0, x1), _ = self.ax[0].viewRange()
+        first = min(max(0, int(x0)), self.config['samples'])
+        last = min(max(0, int(np.ceil(x1)) + 1), self.config['samples'])
+        width = max(1, int(self.ax[0].vb.width()))
+        bucket = 1 << max(0, int(np.log2(max(1, (last - first) / width))))
+        return bucket, first, last
+
+    def get_curves(self, view):
+        # (x, y) for every buffer channel
+        if view is None:
+            return [(self.xdata, self.data[i]) for i in range(self.buffer.channels)] # buffer rows, no copy
+        bucket, first, last = view
+        if bucket == 1: # at most 2 samples per pixel: visible part of the buffer rows, no copy
+            return [(self.xdata[first:last], self.data[i][first:last]) for i in range(self.buffer.channels)]
+        # more samples than pixels: min/max per pixel column, kept up to date by the buffer on every write
+        with self.buffer.lock:
+            if self.decimation is None or self.decimation.block != bucket:
+                if self.decimation is not None:
+                    self.buffer.remove_summary(self.decimation)
+                self.decimation = self.buffer.add_summary(bucket)
+            x, y = self.decimation.envelope(first // bucket, -(-last // bucket))
+        return [(x, y[i]) for i in range(self.buffer.channels)]
+
     def clear(self, event):
         self.output_te.clear()
     
     def closeEvent(self, event):
-        # Stop the timer
+        # Stop the timers
         self.timer.stop()
+        self.stats_timer.stop()
         
-        # Close the serial port if open
-        if self.serial and self.serial.isOpen():
-            self.serial.close()
+        # Stop the acquisition thread, closes the serial port if open
+        self.acquisition.stop()
         
         # Disconnect BLE if connected
         if self.useBLE and self.connected:
-            self.ble.disconnect()
+            asyncio.ensure_future(self.ble.disconnect())
         
         # Close the CSV file if open
-        if self.file:
-            self.file.close()
+        if self.recorder:
+            self.acquisition.set_recorder(None)
+            self.recorder.close()
+            self.recorder = None # closed once, also if the launcher stops writing later
+
+        if self.spectrum is not None:
+            self.spectrum.close()
         
         # Accept the event to close the window
         event.accept()
 
 
     def start_plot_from_0(self):
-        self.idx = 0
+        with self.buffer.lock:
+            self.buffer.reset()
+        self.render.reset()
 
 
 if __name__ == '__main__':
     # command line arguments (overwrite options from config file)
     parser = argparse.ArgumentParser(description='Liveplot from serial port')
-    parser.add_argument("--com", help="COM Port", default=None)
+    parser.add_argument("--com", help="COM Port, \"Address <device address>\" for BLE, tcp://, tcpserver://, udp:// or pipe://", default=None)
     parser.add_argument("--plots", type=int, help="Number of Plots", default=None)
     parser.add_argument("--samples", type=int, help="Number of samples per plot", default=None)
     parser.add_argument("--config", help="config file", default=None)
@@ -0,0 +1,83 @@
+# Project: Serial Data Plotter
+# localhost tests of the socket and pipe transports (SDP_Transport.py), run with: python -m pytest
+
+import os
+import socket
+import tempfile
+import time
+import pytest
+
+from SDP_Transport import gettransport
+
+
+def readall(transport, size, timeout=5.0):
+    # reads until <size> bytes arrived or <timeout> seconds passed
+    data = b''
+    deadline = time.monotonic() + timeout
+    while len(data) < size and time.monotonic() < deadline:
+        data += b''.join(chunk for _, chunk in transport.read(0.02))
+    return data
+
+
+def test_tcp_client():
+    server = socket.create_server(('127.0.0.1', 0))
+    transport = gettransport(F'tcp://127.0.0.1:{server.getsockname()[1]}')
+    transport.open()
+    peer, _ = server.accept()
+    transport.write(b'cmd\r\n')
+    assert peer.recv(100) == b'cmd\r\n'
+    peer.sendall(b'1;2;3\r\n')
+    assert readall(transport, 7) == b'1;2;3\r\n'
+    peer.close()
+    with pytest.raises(OSError):
+        readall(transport, 1)
+    transport.close()
+    server.close()
+
+
+def test_tcp_server_client_waiting_for_command():
+    # the device connects and only sends after it got a command (e.g. "cmdconnect")
+    port = socket.create_server(('127.0.0.1', 0)).getsockname()[1] # a free port
+    transport = gettransport(F'tcpserver://127.0.0.1:{port}')
+    transport.open()
+    device = socket.create_connection(('127.0.0.1', port))
+    assert readall(transport, 1, timeout=0.5) == b''
+    transport.write(b'start\r\n')
+    assert device.recv(100) == b'start\r\n'
+    device.sendall(b'1;2;3\r\n')
+    assert readall(transport, 7) == b'1;2;3\r\n'
+    device.close()
+    assert readall(transport, 1, timeout=0.2) == b'' # disconnect: waits for the next client
+    device = socket.create_connection(('127.0.0.1', port))
+    device.sendall(b'4;5;6\r\n')
+    assert readall(transport, 7) == b'4;5;6\r\n'
+    device.close()
+    transport.close()
+
+
+def test_udp():
+    transport = gettransport('udp://127.0.0.1:0')
+    transport.open()
+    port = transport.socket.getsockname()[1]
+    device = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    device.sendto(b'1;2;3\n', ('127.0.0.1', port))
+    device.sendto(b'4;5;6\n', ('127.0.0.1', port))
+    assert readall(transport, 12) == b'1;2;3\n4;5;6\n'
+    transport.write(b'cmd\r\n') # to the sender of the last datagram
+    assert device.recv(100) == b'cmd\r\n'
+    device.close()
+    transport.close()
+
+
+@pytest.mark.skipif(not hasattr(os, 'mkfifo'), reason='POSIX FIFO')
+def test_pipe():
+    path = os.path.join(tempfile.mkdtemp(), 'fifo')
+    os.mkfifo(path)
+    transport = gettransport(F'pipe://{path}')
+    transport.open()
+    assert readall(transport, 1, timeout=0.1) == b'' # no writer yet
+    with open(path, 'wb') as f:
+        f.write(b'1;2;3\n')
+    assert readall(transport, 6) == b'1;2;3\n'
+    transport.close()
+    os.remove(path)